@@ -14,6 +14,9 @@ from flask_babel import Babel, lazy_gettext as _l
 from logging.handlers import  SMTPHandler, RotatingFileHandler
 
 from config import Config
+from application.cache import NullCache, RedisCache, make_cache
+from application.storage import LocalStorage
+from application.search import make_search_backend
 from elasticsearch import Elasticsearch
 
 
@@ -46,9 +49,41 @@ def create_app(config_class=Config):
 
     app.elasticsearch = Elasticsearch([app.config["ELASTICSEARCH_URL"]]) \
         if app.config["ELASTICSEARCH_URL"] else None
+    app.search_backend = make_search_backend(app)
     app.redis = Redis.from_url(app.config["REDIS_URL"])
     app.task_queue = rq.Queue(app.config["EXPORT_TASK_QUEUE"],
                               connection=app.redis)
+    app.export_storage = LocalStorage(app.config["EXPORT_STORAGE_PATH"])
+    # revocations must be seen by every worker, so tokens are only cached
+    # in Redis, and only along with users, as a token hit would otherwise
+    # still query the user
+    app.token_cache = make_cache(app, "TOKEN") \
+        if app.config["TOKEN_CACHE_REDIS"] and app.config["IDENTITY_CACHE"] \
+        else NullCache()
+    # as must changes to users, so identities are only cached there too
+    app.identity_cache = RedisCache(
+        app.redis, "microblog:identity:", app.config["IDENTITY_CACHE_TTL"]) \
+        if app.config["IDENTITY_CACHE"] else NullCache()
+    app.search_cache = make_cache(app, "SEARCH")
+    app.translation_cache = make_cache(app, "TRANSLATION", tiered=True)
+
+    from application.translate import make_session
+    app.translator = make_session(app)
+
+    from application.language import make_detector
+    app.language_detector = make_detector(app)
+
+    from application.pretranslate import Pretranslator
+    app.pretranslator = Pretranslator(app)
+
+    from application.email import MailDispatcher
+    app.mailer = MailDispatcher(app)
+
+    from application.last_seen import LastSeenBuffer
+    app.last_seen = LastSeenBuffer(app)
+
+    from application.usernames import make_username_index
+    app.username_index = make_username_index(app)
 
     from application.main import bp as main_bp
     app.register_blueprint(main_bp)
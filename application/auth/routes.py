@@ -10,6 +10,7 @@ from application.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
 from application.models.user import User
 from application.auth.email import send_password_reset_email
+from application.email import MailQueueFull
 
 
 @bp.route("/register", methods=["GET", "POST"])
@@ -58,7 +59,12 @@ def reset_password_request():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user:
-            send_password_reset_email(user)
+            try:
+                send_password_reset_email(user)
+            except MailQueueFull:
+                flash(_("We could not send the email right now, "
+                        "please try again in a few minutes"))
+                return redirect(url_for("auth.reset_password_request"))
         flash(_("Please check your email for instructions to reset password"))
         return redirect(url_for("auth.login"))    
     return render_template("auth/reset_password_request.html", title=_("Reset Password"), 
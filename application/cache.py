@@ -0,0 +1,175 @@
+import pickle
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache(object):
+    """Process-local LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    """Cache shared between processes, stored as pickled Redis strings.
+
+    Hits and misses are counted per process and added to the totals of all
+    processes in the stats_key hash every report_every lookups, see
+    cache_stats().
+    """
+    stats_key = "microblog:cache_stats"
+
+    def __init__(self, redis, prefix, ttl=60, report_every=100):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.report_every = report_every
+        self.hits = 0
+        self.misses = 0
+        self._reported = (0, 0)
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if self.hits + self.misses - sum(self._reported) >= self.report_every:
+            self.report()
+        return None if value is None else pickle.loads(value)
+
+    def report(self):
+        hits, misses = self.hits, self.misses
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(self.stats_key, self.prefix + "hits",
+                     hits - self._reported[0])
+        pipe.hincrby(self.stats_key, self.prefix + "misses",
+                     misses - self._reported[1])
+        pipe.execute()
+        self._reported = (hits, misses)
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(self.prefix + key, pickle.dumps(value),
+                       ex=self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.redis.scan_iter(self.prefix + "*"):
+            self.redis.delete(key)
+
+
+class NullCache(object):
+    """Cache that stores nothing, for lookups that must always be read
+    from their source."""
+    hits = 0
+    misses = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class TieredCache(object):
+    """Process-local cache in front of a shared one. Hits in the shared
+    cache are copied to the local one."""
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    @property
+    def hits(self):
+        return self.local.hits + self.shared.hits
+
+    @property
+    def misses(self):
+        return self.shared.misses
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+
+def make_cache(app, name, tiered=False):
+    """Build the cache configured by the <NAME>_CACHE_* settings of app.
+
+    With tiered, a Redis cache gets a process-local LRU cache in front.
+    """
+    ttl = app.config[f"{name}_CACHE_TTL"]
+    local = LRUCache(app.config[f"{name}_CACHE_SIZE"], ttl)
+    if app.config[f"{name}_CACHE_REDIS"]:
+        shared = RedisCache(app.redis, f"microblog:{name.lower()}:", ttl)
+        return TieredCache(local, shared) if tiered else shared
+    return local
+
+
+def cache_stats(redis):
+    """Return {prefix: (hits, misses)} counted by the Redis caches of every
+    process."""
+    stats = {}
+    for field, count in redis.hgetall(RedisCache.stats_key).items():
+        prefix, kind = field.decode("utf-8").rsplit(":", 1)
+        hits, misses = stats.get(prefix, (0, 0))
+        stats[prefix] = (hits + int(count), misses) if kind == "hits" \
+            else (hits, misses + int(count))
+    return stats
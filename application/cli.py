@@ -1,7 +1,15 @@
 import os
+import time
 import click
 
-from application import app
+from datetime import datetime, timedelta
+
+from application import app, db
+from application.cache import cache_stats
+from application.models.user import User
+from application.models.post import Post
+from application.models.search_outbox import SearchOutbox
+from application.models.task import Task
 
 
 def register(app):
@@ -38,3 +46,144 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d application/translations'):
             raise RuntimeError('compile command failed')
+
+
+    @app.cli.group()
+    def timeline():
+        """Home timeline maintenance commands."""
+        pass
+
+
+    @timeline.command()
+    @click.argument("username", required=False)
+    def rebuild(username):
+        """Rebuild home timelines from the posts and followers tables."""
+        users = User.query.filter_by(username=username) if username \
+            else User.query
+        for user in users:
+            user.rebuild_timeline()
+            db.session.commit()
+
+
+    @timeline.command()
+    @click.option("--days", default=30, help="Inactivity period in days.")
+    def evict(days):
+        """Drop the home timelines of users inactive for DAYS days."""
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        for user in User.query.filter(User.last_seen < cutoff,
+                                      User.timeline_built_on.isnot(None)):
+            user.evict_timeline()
+        db.session.commit()
+
+
+    @app.cli.group()
+    def counters():
+        """User counter maintenance commands."""
+        pass
+
+
+    @counters.command()
+    def recompute():
+        """Recompute post, follower, following and unread message counts."""
+        User.recompute_counters()
+        db.session.commit()
+
+
+    @app.cli.group()
+    def users():
+        """User directory commands."""
+        pass
+
+
+    @users.command()
+    def index():
+        """Rebuild the username prefix index."""
+        count = app.username_index.rebuild()
+        click.echo(f"Indexed {count} usernames")
+
+
+    @app.cli.group()
+    def caches():
+        """Cache commands."""
+        pass
+
+
+    @caches.command()
+    def stats():
+        """Show the hits and misses of the Redis caches of all processes."""
+        for prefix, (hits, misses) in sorted(cache_stats(app.redis).items()):
+            rate = hits / (hits + misses) if hits + misses else 0.0
+            click.echo(f"{prefix}: {hits} hits, {misses} misses, "
+                       f"{rate:.1%} hit rate")
+
+
+    @app.cli.group()
+    def exports():
+        """Post export maintenance commands."""
+        pass
+
+
+    @exports.command()
+    def cleanup():
+        """Delete export archives older than EXPORT_TTL seconds."""
+        removed = Task.cleanup_artifacts(app.export_storage,
+                                         app.config["EXPORT_TTL"])
+        click.echo(f"Removed {removed} expired exports")
+
+
+    @app.cli.group()
+    def search():
+        """Search index maintenance commands."""
+        pass
+
+
+    @search.command()
+    @click.option("--batch-size", type=int,
+                  help="Documents per bulk request.")
+    @click.option("--workers", type=int,
+                  help="Number of concurrent bulk requests.")
+    def reindex(batch_size, workers):
+        """Rebuild the post index and swap its alias to the new index."""
+        if not app.search_backend:
+            raise click.ClickException("No search backend is configured")
+        result = Post.reindex(
+            batch_size or app.config["SEARCH_REINDEX_BATCH_SIZE"],
+            workers or app.config["SEARCH_REINDEX_WORKERS"])
+        rate = result["indexed"] / max(result["seconds"], 1e-6)
+        click.echo(f"Indexed {result['indexed']} posts into {result['index']}"
+                   f" in {result['seconds']:.1f}s ({rate:.0f} docs/s),"
+                   f" {result['failed']} failed")
+
+
+    @search.command()
+    def consume():
+        """Apply queued search index changes, and the changes a backend
+        that doesn't queue them failed to apply, until interrupted."""
+        if not app.search_backend:
+            raise click.ClickException("No search backend is configured")
+        models = Post.searchable_models()
+        batch_size = app.config["SEARCH_OUTBOX_BATCH_SIZE"]
+        while True:
+            try:
+                drained, lag = SearchOutbox.drain(models, batch_size)
+            except Exception:
+                db.session.rollback()
+                app.logger.error("Search outbox drain failed", exc_info=True)
+                drained, lag = 0, 0.0
+            if lag > app.config["SEARCH_OUTBOX_MAX_LAG"]:
+                app.logger.warning("Search index is %.1fs behind", lag)
+            if drained < batch_size:
+                time.sleep(app.config["SEARCH_OUTBOX_INTERVAL"])
+
+
+    @search.command()
+    def status():
+        """Show the queued search index changes and their lag."""
+        pending, lag = SearchOutbox.lag()
+        click.echo(f"{pending} pending changes, oldest {lag:.1f}s old, "
+                   f"{SearchOutbox.dead_letters()} dead letters")
+
+    @search.command()
+    def requeue():
+        """Retry the search index changes given up on as dead letters."""
+        click.echo(f"Requeued {SearchOutbox.requeue()} changes")
@@ -1,4 +1,8 @@
-from threading import Thread
+import queue
+import smtplib
+
+from threading import Lock, Thread
+from time import sleep
 
 from flask import current_app
 from flask_mail import Message
@@ -7,9 +11,111 @@ from flask_mail import Message
 from application import mail, app
 
 
+class MailQueueFull(Exception):
+    pass
+
+
+class MailDispatcher(object):
+    """Sends queued messages from a fixed pool of MAIL_WORKERS threads.
+
+    Each worker takes up to MAIL_BATCH_SIZE waiting messages and sends them
+    over one SMTP connection. Temporary failures are retried MAIL_RETRIES
+    times with exponential backoff on a fresh connection; permanent ones
+    are logged and dropped. The queue holds MAIL_QUEUE_SIZE messages, and
+    submit() blocks for up to MAIL_QUEUE_TIMEOUT seconds when it is full
+    before raising MailQueueFull.
+    """
+
+    def __init__(self, app=None):
+        self._threads = []
+        self._lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config["MAIL_WORKERS"]
+        self.batch_size = app.config["MAIL_BATCH_SIZE"]
+        self.retries = app.config["MAIL_RETRIES"]
+        self.backoff = app.config["MAIL_RETRY_BACKOFF"]
+        self.timeout = app.config["MAIL_QUEUE_TIMEOUT"]
+        self.queue = queue.Queue(app.config["MAIL_QUEUE_SIZE"])
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._work, daemon=True,
+                                name=f"mail-{len(self._threads)}")
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, message):
+        if len(self._threads) < self.workers:
+            self._start()
+        try:
+            self.queue.put(message, timeout=self.timeout)
+        except queue.Full:
+            raise MailQueueFull("the outbound mail queue is full")
+
+    def join(self):
+        """Wait until every submitted message was sent or given up on."""
+        self.queue.join()
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.send_batch(batch)
+                except Exception:
+                    self.app.logger.exception("Mail worker failed")
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+    def send_batch(self, batch):
+        """Send messages over as few SMTP connections as failures allow."""
+        pending = list(batch)
+        attempt = 0
+        while pending:
+            try:
+                with self.app.extensions["mail"].connect() as connection:
+                    while pending:
+                        connection.send(pending[0])
+                        pending.pop(0)
+                        self.sent += 1
+                        attempt = 0
+            except Exception as e:
+                if not pending:
+                    # the messages went out, only closing the connection failed
+                    break
+                # anything but a connection or 4xx SMTP error is a problem
+                # with the message itself, e.g. a bad header
+                permanent = not isinstance(
+                    e, (smtplib.SMTPException, OSError)) or \
+                    isinstance(e, smtplib.SMTPRecipientsRefused) or \
+                    getattr(e, "smtp_code", 0) >= 500
+                attempt += 1
+                if permanent or attempt > self.retries:
+                    self.app.logger.error(
+                        "Could not send mail to %s", pending[0].send_to,
+                        exc_info=True)
+                    pending.pop(0)
+                    self.failed += 1
+                    attempt = 0
+                else:
+                    sleep(self.backoff * 2 ** (attempt - 1))
+
+
 def send_async_email(app, message):
-    with app.app_context():
-        mail.send(message)
+    app.mailer.submit(message)
 
 
 def send_mail(subject, sender, recipients, body, html,
@@ -23,5 +129,4 @@ def send_mail(subject, sender, recipients, body, html,
     if sync:
         mail.send(message)
     else:
-        Thread(target=send_async_email, 
-                args=(current_app._get_current_object(), message)).start()
+        send_async_email(current_app._get_current_object(), message)
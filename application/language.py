@@ -0,0 +1,67 @@
+from threading import Lock
+
+
+class GuessLanguageDetector(object):
+    """Trigram detector from guess_language."""
+    name = "guess_language"
+
+    def load(self):
+        # guess_language reads its trigram models on the first call
+        self.detect("This sentence warms up the language models.")
+
+    def detect(self, text):
+        from guess_language import guess_language
+        language = guess_language(text)
+        return None if language == "UNKNOWN" else language
+
+
+class LangdetectDetector(object):
+    """Naive Bayes detector from langdetect, seeded to be deterministic."""
+    name = "langdetect"
+
+    def __init__(self):
+        self._factory = None
+        self._lock = Lock()
+
+    def load(self):
+        from langdetect import detector_factory
+        with self._lock:
+            if self._factory is None:
+                detector_factory.init_factory()
+                detector_factory._factory.set_seed(0)
+                self._factory = detector_factory._factory
+
+    def detect(self, text):
+        from langdetect.lang_detect_exception import LangDetectException
+        if self._factory is None:
+            self.load()
+        detector = self._factory.create()
+        detector.append(text)
+        try:
+            language = detector.detect()
+        except LangDetectException:
+            return None
+        return None if language == "unknown" else language
+
+
+DETECTORS = {
+    "guess_language": GuessLanguageDetector,
+    "langdetect": LangdetectDetector
+}
+
+
+def make_detector(app):
+    """Build the LANGUAGE_DETECTOR of app, loading its models right away
+    unless LANGUAGE_DETECTOR_PRELOAD is off."""
+    detector = DETECTORS[app.config["LANGUAGE_DETECTOR"]]()
+    if app.config["LANGUAGE_DETECTOR_PRELOAD"]:
+        detector.load()
+    return detector
+
+
+def detect_language(detector, text):
+    """Return the language code of text, "" when it can't be told."""
+    language = detector.detect(text) if text else None
+    if not language or len(language) > 5:
+        return ""
+    return language
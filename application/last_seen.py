@@ -0,0 +1,127 @@
+import atexit
+
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from application import db
+from application.models.user import User
+
+
+class LastSeenBuffer(object):
+    """Buffers last_seen timestamps and writes them to the user table in
+    bulk, either after flush_size users or every flush_interval seconds.
+
+    A user is re-recorded at most once per resolution seconds. Buffered
+    values live in this process unless a Redis connection is given, in
+    which case they are kept in a Redis hash shared by all workers. Once
+    something was recorded, a background thread also flushes every
+    flush_interval seconds, so quiet periods don't hold values back, and
+    the buffer is flushed when the process exits.
+    """
+    key = "microblog:last_seen"
+
+    def __init__(self, app=None):
+        self._pending = {}
+        self._lock = Lock()
+        self._flushed_at = monotonic()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.resolution = timedelta(
+            seconds=app.config["LAST_SEEN_RESOLUTION"])
+        self.flush_size = app.config["LAST_SEEN_FLUSH_SIZE"]
+        self.flush_interval = app.config["LAST_SEEN_FLUSH_INTERVAL"]
+        self.redis = app.redis if app.config["LAST_SEEN_REDIS"] else None
+
+    def get(self, user_id):
+        if self.redis is not None:
+            value = self.redis.hget(self.key, user_id)
+            return datetime.fromisoformat(value.decode()) if value else None
+        return self._pending.get(user_id)
+
+    def get_many(self, user_ids):
+        """Return {user_id: timestamp} for the given users that have one
+        buffered, reading the Redis hash with a single HMGET."""
+        if self.redis is not None:
+            if not user_ids:
+                return {}
+            values = self.redis.hmget(self.key, user_ids)
+            return {user_id: datetime.fromisoformat(value.decode())
+                    for user_id, value in zip(user_ids, values) if value}
+        with self._lock:
+            return {user_id: self._pending[user_id] for user_id in user_ids
+                    if user_id in self._pending}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._flush_periodically,
+                                  daemon=True, name="last-seen-flush")
+            self._thread.start()
+        atexit.register(self._safe_flush)
+
+    def _flush_periodically(self):
+        while True:
+            sleep(max(self.flush_interval - (monotonic() - self._flushed_at),
+                      0.1))
+            if monotonic() - self._flushed_at >= self.flush_interval:
+                self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.error("Could not flush last seen times",
+                                  exc_info=True)
+
+    def touch(self, user):
+        now = datetime.utcnow()
+        last_seen = self.get(user.id) or user.last_seen
+        if last_seen is not None and now - last_seen < self.resolution:
+            return
+        if self._thread is None:
+            self._start()
+        if self.redis is not None:
+            self.redis.hset(self.key, user.id, now.isoformat())
+            size = self.redis.hlen(self.key)
+        else:
+            with self._lock:
+                self._pending[user.id] = now
+                size = len(self._pending)
+        if size >= self.flush_size or \
+                monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def _take(self):
+        if self.redis is None:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            return pending
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.key)
+        pipe.delete(self.key)
+        pending, _ = pipe.execute()
+        return {int(user_id): datetime.fromisoformat(value.decode())
+                for user_id, value in pending.items()}
+
+    def flush(self):
+        """Write the buffered timestamps in one executemany UPDATE."""
+        self._flushed_at = monotonic()
+        pending = self._take()
+        if not pending:
+            return 0
+        with db.get_engine(self.app).begin() as connection:
+            connection.execute(
+                User.__table__.update().where(
+                    User.id == db.bindparam("user_id")
+                ).values(last_seen=db.bindparam("seen")),
+                [{"user_id": user_id, "seen": seen}
+                 for user_id, seen in pending.items()])
+        for user_id in pending:
+            self.app.identity_cache.delete(str(user_id))
+        return len(pending)
@@ -1,28 +1,45 @@
+import os
+import re
+
 from flask import render_template, flash, redirect, url_for, \
-    request, g, jsonify, current_app
+    request, g, jsonify, current_app, abort, Response, stream_with_context, \
+    send_file
 from flask_babel import _, get_locale
 from flask_login import current_user, login_user, logout_user, login_required
 
-from datetime import datetime
-from guess_language import guess_language
+from http import HTTPStatus
 from werkzeug.urls import url_parse
 
 from application import db
 from application.main.forms import EditProfileForm, PostForm, \
     EmptyForm, SearchForm, MessageForm
-from application.translate import translate
+from application.translate import translate, translate_many
+from application.pagination import paginate_view
 from application.models.user import User
 from application.models.post import Post
 from application.models.notification import Notification
 from application.models.message import Message
+from application.models.task import Task
+from application.models.timeline import Timeline
 from application.main import bp
 
 
+LANGUAGE_CODE = re.compile(r"[a-z]{2,3}([-_][a-z0-9]{2,8})*", re.IGNORECASE)
+
+
+def language_code(value):
+    """Return value if it looks like a language code such as "es" or
+    "zh-Hans", raising ValueError otherwise."""
+    if not isinstance(value, str) or len(value) > 16 or \
+            not LANGUAGE_CODE.fullmatch(value):
+        raise ValueError(f"not a language code: {value!r}")
+    return value
+
+
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen.touch(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -32,14 +49,14 @@ def before_request():
 def search():
     if not g.search_form.validate():
         return redirect(url_for("main.explore"))
-    page = request.args.get("page", 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, 
-                                current_app.config["POSTS_PER_PAGE"])
-    next_page = url_for("main.search", q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config["POSTS_PER_PAGE"] else None
-
-    prev_page = url_for("main.seatch", q=g.search_form.q.data, page=page -1) \
-        if page > 1 else None
+    after = request.args.get("after")
+    posts, total, cursor = Post.search(
+        g.search_form.q.data, current_app.config["POSTS_PER_PAGE"], after,
+        options=[db.selectinload(Post.author)])
+    next_page = url_for("main.search", q=g.search_form.q.data, after=cursor) \
+        if cursor else None
+    prev_page = url_for("main.search", q=g.search_form.q.data) \
+        if after else None
 
     return render_template("search.html", title=_("Search"), posts=posts,
                             next_page=next_page, prev_page=prev_page)
@@ -54,29 +71,62 @@ def translate_text():
     return jsonify({"text": text})
 
 
+@bp.route("/translate/batch", methods=["POST"])
+@login_required
+def translate_batch():
+    """Translate many posts (by id) or texts in one request.
+
+    Takes {"dest_language": ..., "post_ids": [...]} or
+    {"dest_language": ..., "texts": [{"text": ..., "src_language": ...}]}.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        abort(HTTPStatus.BAD_REQUEST)
+    dest_language = data.get("dest_language") or g.locale
+    post_ids = data.get("post_ids") or []
+    texts = data.get("texts") or []
+    try:
+        if not isinstance(post_ids, list) or not isinstance(texts, list):
+            raise TypeError("post_ids and texts must be lists")
+        if len(post_ids) + len(texts) > \
+                current_app.config["TRANSLATE_MAX_ITEMS"]:
+            abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        dest_language = language_code(dest_language)
+        post_ids = [int(id) for id in post_ids]
+        items = [(str(text["text"]), language_code(text["src_language"]))
+                 for text in texts]
+    except (TypeError, ValueError, KeyError):
+        abort(HTTPStatus.BAD_REQUEST)
+    posts = db.session.query(Post.id, Post.body, Post.language).filter(
+        Post.id.in_(post_ids),
+        Post.language.notin_(["", dest_language])).all() if post_ids else []
+    translations = translate_many(
+        [(body, language) for _, body, language in posts] + items,
+        dest_language)
+    return jsonify({
+        "posts": {str(id): translation for (id, _, _), translation
+                  in zip(posts, translations)},
+        "texts": translations[len(posts):]
+    })
+
+
 @bp.route("/", methods=["GET", "POST"])
 @bp.route("/index", methods=["GET", "POST"])
 @login_required
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == "UNKNOWN" or len(language) > 5:
-            language = ""
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        post = Post(body=form.post.data, author=current_user)
         post.save()
         flash("Your post is now live!")
         return redirect(url_for("main.index"))
-    page = request.args.get("page", 1, type=int)
-    posts = current_user.following_posts().paginate(
-        page, current_app.config["POSTS_PER_PAGE"], False)
-    next_page = url_for("main.index", page=posts.next_num) \
-        if posts.has_next else None
-    prev_page = url_for("main.index", page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_page, prev_page = paginate_view(
+        current_user.timeline_posts(), "main.index",
+        current_app.config["POSTS_PER_PAGE"],
+        (Timeline.created_on, Timeline.post_id))
+    current_app.pretranslator.record_views(posts)
     return render_template("index.html", title=_("Home"), form=form,
-                            posts=posts.items, next_page=next_page,
+                            posts=posts, next_page=next_page,
                             prev_page=prev_page)
 
 
@@ -84,19 +134,26 @@ def index():
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = user.posts.order_by(Post.created_on.desc()).paginate(
-        page, current_app.config["POSTS_PER_PAGE"], False)
-    next_page = url_for("main.user", username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_page = url_for("main.user", username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_page, prev_page = paginate_view(
+        user.posts, "main.user", current_app.config["POSTS_PER_PAGE"],
+        (Post.created_on, Post.id), username=user.username)
     form = EmptyForm()
     return render_template("user.html", user=user, form=form,
-                            posts=posts.items, next_page=next_page,
+                            posts=posts, next_page=next_page,
                             prev_page=prev_page)
 
 
+@bp.route("/users/autocomplete")
+@login_required
+def autocomplete_users():
+    prefix = request.args.get("q", "").strip()
+    limit = max(1, min(request.args.get("limit", 10, type=int),
+                       current_app.config["USERNAME_COMPLETIONS"]))
+    usernames = current_app.username_index.complete(prefix, limit) \
+        if prefix else []
+    return jsonify({"usernames": usernames})
+
+
 @bp.route("/edit_profile", methods=["GET", "POST"])
 @login_required
 def edit_profile():
@@ -157,14 +214,12 @@ def unfollow(username):
 @bp.route("/explore")
 @login_required
 def explore():
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.created_on.desc()).paginate(
-        page, current_app.config["POSTS_PER_PAGE"], False)
-    next_page = url_for("main.explore", page=posts.next_num) \
-        if posts.has_next else None
-    prev_page = url_for("main.explore", page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template("index.html", title=_("Explore"), posts=posts.items,
+    posts, next_page, prev_page = paginate_view(
+        Post.query.options(db.selectinload(Post.author)), "main.explore",
+        current_app.config["POSTS_PER_PAGE"],
+        (Post.created_on, Post.id))
+    current_app.pretranslator.record_views(posts)
+    return render_template("index.html", title=_("Explore"), posts=posts,
                             next_page=next_page, prev_page=prev_page)
 
 
@@ -197,18 +252,14 @@ def send_message(recipient):
 @bp.route("/messages")
 @login_required
 def messages():
-    current_user.messages_last_read = datetime.utcnow()
-    current_user.add_notification("unread_message_count", 0)
+    current_user.mark_messages_read()
     db.session.commit()
-    page = request.args.get("page", 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.created_on.desc()).paginate(
-            page, current_app.config["MESSAGES_PER_PAGE"], False)
-    next_page = url_for("main.messages", page=messages.next_num) \
-        if messages.has_next else None
-    prev_page = url_for("main.messages", page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template("messages.html", messages=messages.items,
+    messages, next_page, prev_page = paginate_view(
+        current_user.messages_received.options(
+            db.selectinload(Message.author)), "main.messages",
+        current_app.config["MESSAGES_PER_PAGE"],
+        (Message.created_on, Message.id))
+    return render_template("messages.html", messages=messages,
                             next_page=next_page, prev_page=prev_page)
 
 
@@ -225,12 +276,57 @@ def notifications():
     } for n in notifications])
 
 
+@bp.route("/notifications/stream")
+@login_required
+def notification_stream():
+    # each open stream keeps a worker thread busy, so the web process needs
+    # a threaded (gthread, as in the Procfile) or async gunicorn worker
+    # class; sync workers would be used up by a few open tabs
+    if not current_app.config["NOTIFICATION_STREAM"]:
+        abort(HTTPStatus.NOT_FOUND)
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(User.notification_channel(current_user.id))
+    keepalive = current_app.config["NOTIFICATION_STREAM_KEEPALIVE"]
+    # don't hold a database connection for the lifetime of the stream
+    db.session.close()
+
+    def events():
+        try:
+            while True:
+                message = pubsub.get_message(timeout=keepalive)
+                if message is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"data: {message['data'].decode()}\n\n"
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(events()),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
+
+
 @bp.route("/export_posts")
 @login_required
 def export_posts():
     if current_user.get_task_in_progress("export_posts"):
         flash(_("An export task is currently in progress"))
     else:
-        current_user.launch_task("export_posts", _("Exporting posts..."))
+        current_user.launch_task("export_posts", _("Exporting posts..."),
+                                 base_url=request.host_url)
         db.session.commit()
     return redirect(url_for("main.user", username=current_user.username))
+
+
+@bp.route("/exports/<task_id>")
+@login_required
+def download_export(task_id):
+    task = Task.query.filter_by(id=task_id, user=current_user,
+                                name="export_posts").first_or_404()
+    if not task.artifact or not current_app.export_storage.exists(task.artifact):
+        abort(HTTPStatus.NOT_FOUND)
+    return send_file(current_app.export_storage.path(task.artifact),
+                     as_attachment=True,
+                     download_name=os.path.basename(task.artifact),
+                     conditional=True)
@@ -1,12 +1,34 @@
-from flask import url_for
+from flask import url_for, request
+
+from application.pagination import keyset_paginate, decode_cursor
+
+def url_template(endpoint, **kwargs):
+    """Render endpoint's URL once per collection, returning a function that
+    builds it for a given id.
+
+    The URL is built for two ids that differ in one digit; what they share
+    before and after that digit is the text around the id.
+    """
+    first = url_for(endpoint, id=1, **kwargs)
+    second = url_for(endpoint, id=2, **kwargs)
+    start = next(i for i, (a, b) in enumerate(zip(first, second)) if a != b)
+    prefix, suffix = first[:start], first[start + 1:]
+    return lambda id: f"{prefix}{id}{suffix}"
 
 
 class PaginationMixin(object):
+    @staticmethod
+    def serialize(query, items):
+        return query.column_descriptions[0]["entity"].to_dict_many(items)
+
     @staticmethod
     def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+        if "before" in request.args or "after" in request.args:
+            return PaginationMixin.to_cursor_collection_dict(
+                query, per_page, endpoint, **kwargs)
         resources = query.paginate(page, per_page, False)
         data = {
-            "items": [item.to_dict() for item in resources.items],
+            "items": PaginationMixin.serialize(query, resources.items),
             "_meta": {
                 "page": page,
                 "per_page": per_page,
@@ -23,3 +45,33 @@ class PaginationMixin(object):
             }
         }
         return data
+
+    @staticmethod
+    def to_cursor_collection_dict(query, per_page, endpoint, **kwargs):
+        model = query.column_descriptions[0]["entity"]
+        before = request.args.get("before")
+        after = request.args.get("after")
+        resources = keyset_paginate(query, per_page,
+                                    (model.created_on, model.id),
+                                    before=decode_cursor(before),
+                                    after=decode_cursor(after))
+        cursor = {"after": after} if after else {"before": before or ""}
+        data = {
+            "items": PaginationMixin.serialize(query, resources.items),
+            "_meta": {
+                "per_page": per_page
+            },
+            "_links": {
+                "self": url_for(endpoint, per_page=per_page, **cursor,
+                                **kwargs),
+                "next": url_for(endpoint, before=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.next_cursor else None,
+                "prev": url_for(endpoint, after=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.prev_cursor else None
+            }
+        }
+        if request.args.get("include_total", type=int):
+            data["_meta"]["total_items"] = query.order_by(None).count()
+        return data
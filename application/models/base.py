@@ -1,7 +1,10 @@
 from datetime import datetime
 
+from flask import current_app
+
 from application import db
-from application.search import add_to_index, remove_from_index, query_index
+from application.models.search_outbox import SearchOutbox
+from application.search import query_index, rebuild_index, apply_changes
 
 
 class CRUDMixin(object):
@@ -37,42 +40,100 @@ class CreateUpdateTimesMixin(object):
 
 class SearchableMixin(object):
     @classmethod
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+    def search(cls, expression, per_page, after=None, options=()):
+        """Return the matching objects in rank order, loaded with the query
+        options, the total number of matches and the cursor of the next
+        page."""
+        ids, total, cursor = query_index(cls.__tablename__, expression,
+                                         per_page, after)
+        if not ids:
+            return [], total, None
+        objects = {obj.id: obj for obj in
+                   cls.query.filter(cls.id.in_(ids)).options(*options)}
+        return [objects[id] for id in ids if id in objects], total, cursor
 
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            "add": list(session.new),
-            "update": list(session.dirty),
-            "delete": list(session.deleted)
-        }
+    @staticmethod
+    def after_flush(session, flush_context):
+        """Record changes to searchable fields.
 
-    @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes["add"]:
+        Backends that queue changes get them in the search outbox, in the
+        same transaction as the changes themselves. For the others the
+        new documents are kept until after_commit applies them.
+        """
+        backend = current_app.search_backend
+        if not backend:
+            return
+        changes = {}
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["update"]:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__. obj)
-        for obj in session._changes["delete"]:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                changes[obj.__tablename__, obj.id] = None
+        for obj in session.new | session.dirty:
+            if isinstance(obj, SearchableMixin) and obj not in \
+                    session.deleted and (obj in session.new or any(
+                        db.inspect(obj).attrs[field].history.has_changes()
+                        for field in obj.__searchable__)):
+                changes[obj.__tablename__, obj.id] = {
+                    field: getattr(obj, field)
+                    for field in obj.__searchable__}
+        if backend.queued:
+            SearchOutbox.record(session.connection(), changes)
+        else:
+            session.info.setdefault("search_changes", {}).update(changes)
+
+    @staticmethod
+    def after_commit(session):
+        """Apply the changes of backends that don't queue them. The data is
+        already committed, so a failure is logged and the changes are
+        recorded in the search outbox for `flask search consume` to retry
+        rather than raised."""
+        changes = session.info.pop("search_changes", None)
+        if not changes:
+            return
+        try:
+            failed = apply_changes([(index, id, payload) for (index, id),
+                                    payload in changes.items()])
+        except Exception:
+            current_app.logger.error("Search index update failed",
+                                     exc_info=True)
+            failed = list(changes)
+        if not failed:
+            return
+        try:
+            with db.get_engine(current_app).begin() as connection:
+                SearchOutbox.record(connection, failed)
+        except Exception:
+            current_app.logger.error("Could not queue search index retry",
+                                     exc_info=True)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop("search_changes", None)
+
+    @staticmethod
+    def searchable_models():
+        return {mapper.class_.__tablename__: mapper.class_
+                for mapper in db.Model.registry.mappers
+                if issubclass(mapper.class_, SearchableMixin)}
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.___tablename__, obj)
-            
+    def search_documents(cls, batch_size=500, filter=None):
+        """Yield (id, payload) for every row, or the rows matching filter,
+        streamed batch_size rows at a time."""
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        rows = db.session.query(cls.id, *columns)
+        if filter is not None:
+            rows = rows.filter(filter)
+        rows = rows.order_by(cls.id).yield_per(batch_size)
+        for id, *values in rows:
+            yield id, dict(zip(cls.__searchable__, values))
+
+    @classmethod
+    def reindex(cls, batch_size=500, workers=4):
+        return rebuild_index(cls.__tablename__,
+                             cls.search_documents(batch_size),
+                             batch_size, workers)
+
 
-db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
-db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
\ No newline at end of file
+db.event.listen(db.session, "after_flush", SearchableMixin.after_flush)
+db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+db.event.listen(db.session, "after_rollback", SearchableMixin.after_rollback)
\ No newline at end of file
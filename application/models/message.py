@@ -8,5 +8,10 @@ class Message(CRUDMixin, CreateUpdateTimesMixin, db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     body = db.Column(db.String(140))
 
+    __table_args__ = (
+        db.Index("ix_message_recipient_id_created_on",
+                 "recipient_id", "created_on"),
+    )
+
     def __repr__(self):
         return f"<Message {self.body}"
@@ -10,6 +10,12 @@ class Notification(CRUDMixin, CreateUpdateTimesMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     payload = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index("ix_notification_user_id_name", "user_id", "name"),
+        db.Index("ix_notification_user_id_created_on",
+                 "user_id", "created_on"),
+    )
+
     def __repr__(self):
         return f"<Notification {self.name}"
 
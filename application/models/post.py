@@ -1,11 +1,16 @@
-from flask import url_for
+import redis
+
+from flask import current_app
 
 from application import db
+from application.language import detect_language
+from application.models.api import PaginationMixin, url_template
 from application.models.base import CRUDMixin, CreateUpdateTimesMixin, \
     SearchableMixin
 
 
-class Post(CRUDMixin, CreateUpdateTimesMixin, SearchableMixin, db.Model):
+class Post(CRUDMixin, CreateUpdateTimesMixin, SearchableMixin,
+           PaginationMixin, db.Model):
     __searchable__ = ["body"]
 
     id = db.Column(db.Integer, primary_key=True)
@@ -13,16 +18,74 @@ class Post(CRUDMixin, CreateUpdateTimesMixin, SearchableMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     language = db.Column(db.String(5))
 
+    __table_args__ = (
+        db.Index("ix_post_user_id_created_on", "user_id", "created_on"),
+    )
+
     def __repr__(self):
         return f"<Post {self.body}>"
 
     def to_dict(self):
-        return {
-            "id": self.id,
-            "body": self.body,
-            "language": self.language,
+        return Post.to_dict_many([self])[0]
+
+    @staticmethod
+    def to_dict_many(posts):
+        self_url = url_template("api.get_post")
+        user_url = url_template("api.get_user")
+        return [{
+            "id": post.id,
+            "body": post.body,
+            "language": post.language,
             "_links": {
-                "self": url_for("api.get_post", id=self.id),
-                "user": url_for("api.get_user", id=self.user_id)
+                "self": self_url(post.id),
+                "user": user_url(post.user_id)
             }
-        }
+        } for post in posts]
+
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """Detect the language of short new posts inline. Longer ones are
+        left to detect_post_language after commit."""
+        for obj in session.new:
+            if isinstance(obj, Post) and obj.language is None and (
+                    not current_app.config["LANGUAGE_ASYNC"] or
+                    len(obj.body or "") <=
+                    current_app.config["LANGUAGE_SYNC_MAX_CHARS"]):
+                obj.language = detect_language(current_app.language_detector,
+                                               obj.body)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        for obj in session.new:
+            if not isinstance(obj, Post):
+                continue
+            if obj.language is None:
+                session.info.setdefault("undetected_posts", []).append(obj.id)
+            elif current_app.pretranslator.wants_fan_out(obj):
+                session.info.setdefault("pretranslate_posts", []).append(
+                    (obj.id, obj.body, obj.language))
+
+    @staticmethod
+    def after_commit(session):
+        current_app.pretranslator.enqueue(
+            session.info.pop("pretranslate_posts", None))
+        post_ids = session.info.pop("undetected_posts", None)
+        if not post_ids:
+            return
+        try:
+            current_app.task_queue.enqueue(
+                "application.tasks.detect_post_language", post_ids)
+        except redis.exceptions.RedisError:
+            current_app.logger.warning("Could not queue language detection",
+                                       exc_info=True)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop("undetected_posts", None)
+        session.info.pop("pretranslate_posts", None)
+
+
+db.event.listen(db.session, "before_flush", Post.before_flush)
+db.event.listen(db.session, "after_flush", Post.after_flush)
+db.event.listen(db.session, "after_commit", Post.after_commit)
+db.event.listen(db.session, "after_rollback", Post.after_rollback)
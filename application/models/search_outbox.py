@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from application import db
+from application.search import apply_changes
+
+
+class SearchOutbox(db.Model):
+    """Search index changes recorded in the transaction that made them and
+    applied to Elasticsearch by the consumer in drain().
+
+    Entries the search backend rejects are retried with backoff and, after
+    SEARCH_OUTBOX_MAX_ATTEMPTS attempts, kept as dead letters until
+    requeued.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64))
+    object_id = db.Column(db.Integer)
+    created_on = db.Column(db.DateTime, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.String(256))
+    retry_on = db.Column(db.DateTime)
+    dead = db.Column(db.Boolean, default=False, index=True)
+
+    def __repr__(self):
+        return f"<SearchOutbox {self.index} {self.object_id}>"
+
+    @staticmethod
+    def record(connection, changes):
+        """Insert (index, object_id) rows for the changed objects."""
+        if not changes:
+            return
+        now = datetime.utcnow()
+        connection.execute(SearchOutbox.__table__.insert(), [
+            {"index": index, "object_id": object_id, "created_on": now}
+            for index, object_id in changes])
+
+    @staticmethod
+    def lag():
+        """Return the pending entry count and the age in seconds of the
+        oldest one, leaving out dead letters."""
+        count, oldest = db.session.query(
+            db.func.count(SearchOutbox.id),
+            db.func.min(SearchOutbox.created_on)).filter(
+                SearchOutbox.dead.is_(False)).one()
+        if oldest is None:
+            return 0, 0.0
+        return count, (datetime.utcnow() - oldest).total_seconds()
+
+    @staticmethod
+    def dead_letters():
+        return SearchOutbox.query.filter(SearchOutbox.dead.is_(True)).count()
+
+    @staticmethod
+    def requeue():
+        """Make dead letters pending again, returning how many there were."""
+        count = SearchOutbox.query.filter(SearchOutbox.dead.is_(True)).update(
+            {SearchOutbox.dead: False, SearchOutbox.attempts: 0,
+             SearchOutbox.retry_on: None}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def drain(models, batch_size=500):
+        """Apply up to batch_size pending entries in one bulk request.
+
+        Entries for the same object are coalesced and the object's current
+        row is sent, or a delete if the row no longer exists. Entries are
+        removed only once their change was applied, so a failed request is
+        retried on a later drain. An entry the backend reports an error for
+        is retried after SEARCH_OUTBOX_RETRY_BACKOFF seconds, doubled on
+        every attempt, so it doesn't hold up the entries behind it, and
+        becomes a dead letter after SEARCH_OUTBOX_MAX_ATTEMPTS attempts.
+        Returns the number of entries applied and the lag in seconds of the
+        oldest one.
+        """
+        now = datetime.utcnow()
+        entries = SearchOutbox.query.filter(
+            SearchOutbox.dead.is_(False),
+            db.or_(SearchOutbox.retry_on.is_(None),
+                   SearchOutbox.retry_on <= now)).order_by(
+            SearchOutbox.id).limit(batch_size).with_for_update(
+            skip_locked=True).all()
+        if not entries:
+            db.session.rollback()
+            return 0, 0.0
+        lag = (now - entries[0].created_on).total_seconds()
+        pending = {}
+        for entry in entries:
+            pending.setdefault(entry.index, set()).add(entry.object_id)
+        changes = []
+        for index, ids in pending.items():
+            model = models[index]
+            documents = dict(model.search_documents(filter=model.id.in_(ids)))
+            changes += [(index, id, documents.get(id)) for id in sorted(ids)]
+        failed = apply_changes(changes)
+        applied = []
+        max_attempts = current_app.config["SEARCH_OUTBOX_MAX_ATTEMPTS"]
+        backoff = current_app.config["SEARCH_OUTBOX_RETRY_BACKOFF"]
+        for entry in entries:
+            error = failed.get((entry.index, entry.object_id))
+            if error is None:
+                applied.append(entry.id)
+                continue
+            entry.attempts = (entry.attempts or 0) + 1
+            entry.last_error = error[:256]
+            if entry.attempts >= max_attempts:
+                entry.dead = True
+                current_app.logger.error(
+                    "Giving up on indexing %s %s after %d attempts: %s",
+                    entry.index, entry.object_id, entry.attempts, error)
+            else:
+                entry.retry_on = now + timedelta(
+                    seconds=backoff * 2 ** (entry.attempts - 1))
+        SearchOutbox.query.filter(SearchOutbox.id.in_(applied)).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return len(applied), lag
@@ -11,6 +11,12 @@ class Task(db.Model):
     description = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     complete = db.Column(db.Boolean, default=False)
+    artifact = db.Column(db.String(256))
+
+    __table_args__ = (
+        db.Index("ix_task_user_id_name_complete",
+                 "user_id", "name", "complete"),
+    )
 
     def __repr__(self):
         return f"<Task {self.name}"
@@ -25,3 +31,12 @@ class Task(db.Model):
     def get_progress(self):
         job = self.get_rq_job()
         return job.meta.get("progress", 0) if job is not None else 100
+
+    @staticmethod
+    def cleanup_artifacts(storage, max_age):
+        removed = storage.cleanup(max_age)
+        if removed:
+            Task.query.filter(Task.artifact.in_(removed)).update(
+                {Task.artifact: None}, synchronize_session=False)
+            db.session.commit()
+        return len(removed)
@@ -0,0 +1,16 @@
+from application import db
+
+
+class Timeline(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    post_id = db.Column(db.Integer,
+                        db.ForeignKey("post.id", ondelete="CASCADE"),
+                        primary_key=True)
+    created_on = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_timeline_user_id_created_on", "user_id", "created_on"),
+    )
+
+    def __repr__(self):
+        return f"<Timeline {self.user_id}:{self.post_id}>"
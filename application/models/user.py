@@ -1,36 +1,50 @@
-import jwt, json, rq, base64, os
+import jwt, json, redis, rq, base64, os
 
 from datetime import datetime, timedelta
+from functools import lru_cache
 from hashlib import md5
 from time import time
 
-from flask import current_app, url_for
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.orm import make_transient_to_detached
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from application import db, login
-from application.models.api import PaginationMixin
+from application.models.api import PaginationMixin, url_template
 from application.models.base import CRUDMixin, CreateUpdateTimesMixin
 from application.models.message import Message
 from application.models.post import Post
 from application.models.notification import Notification
 from application.models.task import Task
+from application.models.timeline import Timeline
 
 followers = db.Table("followers",
     db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("following_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("following_id", db.Integer, db.ForeignKey("user.id")),
+    db.Index("ix_followers_follower_id_following_id",
+             "follower_id", "following_id", unique=True),
+    db.Index("ix_followers_following_id", "following_id")
 )
 
 
+@lru_cache(maxsize=4096)
+def gravatar_digest(email):
+    return md5(email.lower().encode("utf-8")).hexdigest()
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return User.get_cached(int(id))
 
 
 class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
             PaginationMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(16), index=True, unique=True)
+    # active history loads the old name of a renamed user whose attributes
+    # expired, so the username index change log records what to remove
+    username = db.column_property(db.Column(db.String(16), index=True,
+                                            unique=True), active_history=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password = db.Column(db.String(64))
     about_me = db.Column(db.String(140))
@@ -52,6 +66,12 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
     tasks = db.relationship("Task", backref="user", lazy="dynamic")
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    timeline_built_on = db.Column(db.DateTime, default=datetime.utcnow)
+    post_count = db.Column(db.Integer, default=0, server_default="0")
+    follower_count = db.Column(db.Integer, default=0, server_default="0")
+    following_count = db.Column(db.Integer, default=0, server_default="0")
+    unread_message_count = db.Column(db.Integer, default=0,
+                                     server_default="0")
 
     def __repr__(self):
         return f"<User {self.username}>"
@@ -63,7 +83,7 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
         return check_password_hash(self.password, password)
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
+        digest = gravatar_digest(self.email)
         return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
 
     def is_following(self, user):
@@ -74,10 +94,16 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
     def follow(self, user):
         if not self.is_following(user):
             self.following.append(user)
+            self.following_count = User.following_count + 1
+            user.follower_count = User.follower_count + 1
+            self.backfill_timeline(user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.following_count = User.following_count - 1
+            user.follower_count = User.follower_count - 1
+            self.prune_timeline(user)
 
     def following_posts(self):
         my_posts = Post.query.filter_by(user_id=self.id)
@@ -86,9 +112,121 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
             followers, (followers.c.following_id == Post.user_id)
         ).filter(followers.c.follower_id == self.id)
 
-        return my_posts.union(my_following_posts).order_by(
-            Post.created_on.desc()
-        )
+        return my_posts.union(my_following_posts).options(
+            db.selectinload(Post.author)
+        ).order_by(Post.created_on.desc())
+
+    def timeline_posts(self):
+        if self.timeline_built_on is None:
+            self.rebuild_timeline()
+            db.session.commit()
+        return Post.query.join(
+            Timeline, Timeline.post_id == Post.id
+        ).filter(Timeline.user_id == self.id).options(
+            db.selectinload(Post.author)
+        ).order_by(Timeline.created_on.desc(), Timeline.post_id.desc())
+
+    def rebuild_timeline(self):
+        self.evict_timeline()
+        posts = self.following_posts().with_entities(
+            db.literal(self.id), Post.id, Post.created_on
+        ).order_by(None)
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ["user_id", "post_id", "created_on"], posts))
+        self.timeline_built_on = datetime.utcnow()
+
+    def evict_timeline(self):
+        Timeline.query.filter_by(user_id=self.id).delete()
+        self.timeline_built_on = None
+
+    def backfill_timeline(self, user):
+        if self.timeline_built_on is None:
+            return
+        posts = db.select([
+            db.literal(self.id), Post.id, Post.created_on
+        ]).where(Post.user_id == user.id)
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ["user_id", "post_id", "created_on"], posts))
+
+    def prune_timeline(self, user):
+        if self.timeline_built_on is None:
+            return
+        Timeline.query.filter(
+            Timeline.user_id == self.id,
+            Timeline.post_id.in_(
+                db.select([Post.id]).where(Post.user_id == user.id))
+        ).delete(synchronize_session=False)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        for obj in session.new:
+            if isinstance(obj, Post):
+                cls.fan_out_post(session.connection(), obj)
+                cls.change_post_count(session.connection(), obj.user_id, 1)
+            elif isinstance(obj, Message):
+                cls.change_unread_message_count(session.connection(),
+                                                obj.recipient_id)
+            elif isinstance(obj, User):
+                session.info.setdefault("username_changes", []).append(
+                    (None, obj.username))
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                history = db.inspect(obj).attrs.username.history
+                if history.has_changes():
+                    session.info.setdefault("username_changes", []).append(
+                        ((history.deleted or [None])[0], obj.username))
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                cls.change_post_count(session.connection(), obj.user_id, -1)
+            elif isinstance(obj, User):
+                session.info.setdefault("username_changes", []).append(
+                    (obj.username, None))
+
+    @staticmethod
+    def change_post_count(connection, user_id, delta):
+        connection.execute(User.__table__.update().where(
+            User.id == user_id
+        ).values(post_count=User.post_count + delta))
+        User.invalidate_cached(user_id)
+
+    @staticmethod
+    def change_unread_message_count(connection, user_id):
+        connection.execute(User.__table__.update().where(
+            User.id == user_id
+        ).values(unread_message_count=User.unread_message_count + 1))
+        User.invalidate_cached(user_id)
+
+    @staticmethod
+    def recompute_counters():
+        post_count = db.select([db.func.count(Post.id)]).where(
+            Post.user_id == User.id).scalar_subquery()
+        follower_count = db.select([db.func.count()]).where(
+            followers.c.following_id == User.id).scalar_subquery()
+        following_count = db.select([db.func.count()]).where(
+            followers.c.follower_id == User.id).scalar_subquery()
+        unread_message_count = db.select([db.func.count(Message.id)]).where(
+            db.and_(Message.recipient_id == User.id,
+                    Message.created_on > db.func.coalesce(
+                        User.messages_last_read, datetime(1900, 1, 1)))
+        ).scalar_subquery()
+        db.session.execute(User.__table__.update().values(
+            post_count=post_count, follower_count=follower_count,
+            following_count=following_count,
+            unread_message_count=unread_message_count))
+        current_app.identity_cache.clear()
+
+    @staticmethod
+    def fan_out_post(connection, post):
+        audience = db.select([
+            User.id, db.literal(post.id), db.literal(post.created_on)
+        ]).where(db.and_(
+            User.timeline_built_on.isnot(None),
+            db.or_(User.id == post.user_id, User.id.in_(
+                db.select([followers.c.follower_id]).where(
+                    followers.c.following_id == post.user_id)))
+        ))
+        connection.execute(Timeline.__table__.insert().from_select(
+            ["user_id", "post_id", "created_on"], audience))
 
     def get_reset_password_token(self, span=1800):
         return jwt.encode(
@@ -108,16 +246,26 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
         return User.query.get(id)
 
     def new_messages(self):
-        last_read = self.messages_last_read or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.created_on > last_read).count()
+        return self.unread_message_count or 0
+
+    def mark_messages_read(self):
+        self.messages_last_read = datetime.utcnow()
+        self.unread_message_count = 0
+        self.add_notification("unread_message_count", 0)
 
     def add_notification(self, name, data):
         self.notifications.filter_by(name=name).delete()
         n = Notification(name=name, payload=json.dumps(data), user=self)
         db.session.add(n)
+        if current_app.config["NOTIFICATION_STREAM"]:
+            db.session.info.setdefault("notifications", []).append(
+                (self.id, {"name": name, "data": data, "timestamp": time()}))
         return n
 
+    @staticmethod
+    def notification_channel(id):
+        return f"microblog:notifications:{id}"
+
     def launch_task(self, name, description, *args, **kwargs):
         rq_job = current_app.task_queue.enqueue("application.tasks." + name,
                                                 self.id, *args, **kwargs)
@@ -133,24 +281,40 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
         return Task.query.filter_by(name=name, user=self,
                                     complete=False).first()
 
+    def get_last_seen(self):
+        return current_app.last_seen.get(self.id) or self.last_seen
+
     def to_dict(self, include_email=False):
-        data = {
-            "id": self.id,
-            "username": self.username,
-            "last_seen": self.last_seen.isoformat() + "Z",
-            "about_me": self.about_me,
-            "post_count": self.posts.count(),
-            "follower_count": self.followers.count(),
-            "following_count": self.following.count(),
-            "_links": {
-                "self": url_for("api.get_user", id=self.id),
-                "followers": url_for("api.get_followers", id=self.id),
-                "following": url_for("api.get_following", id=self.id),
-                "avatar": self.avatar(128)
+        return User.to_dict_many([self], include_email)[0]
+
+    @staticmethod
+    def to_dict_many(users, include_email=False):
+        self_url = url_template("api.get_user")
+        followers_url = url_template("api.get_followers")
+        following_url = url_template("api.get_following")
+        users = list(users)
+        buffered = current_app.last_seen.get_many([user.id for user in users])
+        data = []
+        for user in users:
+            last_seen = buffered.get(user.id) or user.last_seen
+            item = {
+                "id": user.id,
+                "username": user.username,
+                "last_seen": last_seen.isoformat() + "Z",
+                "about_me": user.about_me,
+                "post_count": user.post_count,
+                "follower_count": user.follower_count,
+                "following_count": user.following_count,
+                "_links": {
+                    "self": self_url(user.id),
+                    "followers": followers_url(user.id),
+                    "following": following_url(user.id),
+                    "avatar": user.avatar(128)
+                }
             }
-        }
-        if include_email:
-            data["email"] = self.email
+            if include_email:
+                item["email"] = user.email
+            data.append(item)
         return data
 
     def from_dict(self, data, new_user=False):
@@ -164,6 +328,7 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        self.invalidate_token()
         self.token = base64.b64encode(os.urandom(24)).decode("utf-8")
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -171,10 +336,96 @@ class  User(UserMixin, CRUDMixin, CreateUpdateTimesMixin,
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        self.invalidate_token()
+
+    def invalidate_token(self):
+        if self.token:
+            current_app.token_cache.delete(self.token)
+            # drop it again once committed, in case a concurrent request
+            # cached the old row in the meantime
+            db.session.info.setdefault("stale_tokens", set()).add(self.token)
 
     @staticmethod
     def verify_token(token):
-        user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        """Return the user holding an unexpired token.
+
+        The token cache is only on along with IDENTITY_CACHE, so a hit
+        loads the user from the identity cache without a query.
+        """
+        cached = current_app.token_cache.get(token)
+        if cached is None:
+            user = User.query.filter_by(token=token).first()
+            if user is None:
+                return None
+            cached = (user.id, user.token_expiration)
+            current_app.token_cache.set(token, cached)
+            if current_app.config["IDENTITY_CACHE"]:
+                User.set_cached(user)
+        else:
+            user = None
+        user_id, expiration = cached
+        if expiration < datetime.utcnow():
             return None
-        return user
+        return user or User.get_cached(user_id)
+
+    @staticmethod
+    def set_cached(user):
+        current_app.identity_cache.set(str(user.id), {
+            column.key: getattr(user, column.key)
+            for column in User.__table__.columns})
+
+    @staticmethod
+    def get_cached(id):
+        if not current_app.config["IDENTITY_CACHE"]:
+            return User.query.get(id)
+        data = current_app.identity_cache.get(str(id))
+        if data is None:
+            user = User.query.get(id)
+            if user is not None:
+                User.set_cached(user)
+            return user
+        user = User(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def invalidate_cached(id):
+        current_app.identity_cache.delete(str(id))
+        # drop it again once committed, in case a concurrent request
+        # cached the old row in the meantime
+        db.session.info.setdefault("stale_users", set()).add(id)
+
+    @staticmethod
+    def after_update(mapper, connection, user):
+        User.invalidate_cached(user.id)
+
+    @staticmethod
+    def after_commit(session):
+        for token in session.info.pop("stale_tokens", ()):
+            current_app.token_cache.delete(token)
+        for id in session.info.pop("stale_users", ()):
+            current_app.identity_cache.delete(str(id))
+        for id, notification in session.info.pop("notifications", ()):
+            try:
+                current_app.redis.publish(User.notification_channel(id),
+                                          json.dumps(notification))
+            except redis.exceptions.RedisError:
+                current_app.logger.warning("Could not publish notification",
+                                           exc_info=True)
+        changes = session.info.pop("username_changes", None)
+        if changes:
+            try:
+                current_app.username_index.update(changes)
+            except redis.exceptions.RedisError:
+                current_app.logger.warning("Could not update username index",
+                                           exc_info=True)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop("username_changes", None)
+
+
+db.event.listen(db.session, "after_flush", User.after_flush)
+db.event.listen(db.session, "after_commit", User.after_commit)
+db.event.listen(db.session, "after_rollback", User.after_rollback)
+db.event.listen(User, "after_update", User.after_update)
@@ -0,0 +1,88 @@
+import base64
+
+from datetime import datetime
+from http import HTTPStatus
+
+from flask import request, url_for, abort
+
+from application import db
+
+
+class KeysetPage(object):
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return encode_cursor(self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return encode_cursor(self.items[0])
+
+
+def encode_cursor(item):
+    key = f"{item.created_on.isoformat()}|{item.id}"
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        created_on, id = base64.urlsafe_b64decode(
+            cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(created_on), int(id)
+    except (ValueError, UnicodeError):
+        abort(HTTPStatus.BAD_REQUEST)
+
+
+def keyset_paginate(query, per_page, keys, before=None, after=None):
+    """Page through query newest first on the (created_on, id) columns in
+    keys, returning the rows older than before or newer than after."""
+    created_on, id = keys
+    query = query.order_by(None)
+    if after is not None:
+        items = query.filter(db.or_(
+            created_on > after[0],
+            db.and_(created_on == after[0], id > after[1]))
+        ).order_by(created_on.asc(), id.asc()).limit(per_page + 1).all()
+        return KeysetPage(items[:per_page][::-1], has_next=True,
+                          has_prev=len(items) > per_page)
+    if before is not None:
+        query = query.filter(db.or_(
+            created_on < before[0],
+            db.and_(created_on == before[0], id < before[1])))
+    items = query.order_by(created_on.desc(), id.desc()).limit(
+        per_page + 1).all()
+    return KeysetPage(items[:per_page], has_next=len(items) > per_page,
+                      has_prev=before is not None)
+
+
+def paginate_view(query, endpoint, per_page, keys, **kwargs):
+    """Paginate query for an HTML view from the request arguments.
+
+    Uses the page number when a "page" argument is given and keyset
+    cursors otherwise. Returns the items and the next/prev page URLs.
+    """
+    page = request.args.get("page", type=int)
+    if page is not None:
+        resources = query.order_by(None).order_by(
+            *[key.desc() for key in keys]).paginate(page, per_page, False)
+        next_page = url_for(endpoint, page=resources.next_num, **kwargs) \
+            if resources.has_next else None
+        prev_page = url_for(endpoint, page=resources.prev_num, **kwargs) \
+            if resources.has_prev else None
+        return resources.items, next_page, prev_page
+    resources = keyset_paginate(query, per_page, keys,
+                                before=decode_cursor(request.args.get("before")),
+                                after=decode_cursor(request.args.get("after")))
+    next_page = url_for(endpoint, before=resources.next_cursor, **kwargs) \
+        if resources.next_cursor else None
+    prev_page = url_for(endpoint, after=resources.prev_cursor, **kwargs) \
+        if resources.prev_cursor else None
+    return resources.items, next_page, prev_page
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+import redis
+
+
+class Pretranslator(object):
+    """Queues translation jobs for posts likely to be read by many users,
+    so their translations are already cached when someone asks.
+
+    A post qualifies once its author has PRETRANSLATE_MIN_FOLLOWERS
+    followers when it is published, or once it has been shown
+    PRETRANSLATE_MIN_VIEWS times on explore or in timelines. Each post is
+    queued at most once, nothing is queued while the task queue holds
+    PRETRANSLATE_MAX_QUEUE jobs, and at most PRETRANSLATE_DAILY_CHARS
+    characters are sent to the translator per day.
+
+    Results are stored in the translation cache, so this is only enabled
+    when that cache is shared through Redis.
+    """
+    prefix = "microblog:pretranslate:"
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config["PRETRANSLATE"] and \
+            app.config["TRANSLATION_CACHE_REDIS"]
+        self.languages = app.config["LANGUAGES"]
+        self.min_followers = app.config["PRETRANSLATE_MIN_FOLLOWERS"]
+        self.min_views = app.config["PRETRANSLATE_MIN_VIEWS"]
+        self.max_queue = app.config["PRETRANSLATE_MAX_QUEUE"]
+        self.daily_chars = app.config["PRETRANSLATE_DAILY_CHARS"]
+        self.ttl = app.config["TRANSLATION_CACHE_TTL"]
+
+    def targets(self, language):
+        if not language:
+            return []
+        return [target for target in self.languages if target != language]
+
+    def wants_fan_out(self, post):
+        return self.enabled and bool(self.targets(post.language)) and \
+            (post.author.follower_count or 0) >= self.min_followers
+
+    def record_views(self, posts):
+        """Count a view of each translatable post and queue the ones that
+        just reached the view threshold."""
+        if not self.enabled:
+            return 0
+        posts = [post for post in posts if self.targets(post.language)]
+        if not posts:
+            return 0
+        try:
+            pipe = self.app.redis.pipeline()
+            for post in posts:
+                pipe.incr(f"{self.prefix}views:{post.id}")
+                pipe.expire(f"{self.prefix}views:{post.id}", 86400)
+            views = pipe.execute()[::2]
+        except redis.exceptions.RedisError:
+            self.app.logger.warning("Could not count post views",
+                                    exc_info=True)
+            return 0
+        return self.enqueue([(post.id, post.body, post.language)
+                             for post, count in zip(posts, views)
+                             if count == self.min_views])
+
+    def _reserve(self, chars):
+        key = f"{self.prefix}budget:{datetime.utcnow():%Y%m%d}"
+        pipe = self.app.redis.pipeline()
+        pipe.incrby(key, chars)
+        pipe.expire(key, 2 * 86400)
+        spent, _ = pipe.execute()
+        if spent > self.daily_chars:
+            self.app.redis.decrby(key, chars)
+            return False
+        return True
+
+    def enqueue(self, posts):
+        """Queue a translation job for the (id, body, language) posts not
+        queued before, within the queue and budget limits. Returns the
+        number of posts queued."""
+        if not self.enabled or not posts:
+            return 0
+        try:
+            if self.app.task_queue.count >= self.max_queue:
+                return 0
+            selected = []
+            for id, body, language in posts:
+                if not self.app.redis.set(f"{self.prefix}queued:{id}", 1,
+                                          nx=True, ex=self.ttl):
+                    continue
+                if not self._reserve(len(body) * len(self.targets(language))):
+                    self.app.redis.delete(f"{self.prefix}queued:{id}")
+                    break
+                selected.append(id)
+            if selected:
+                self.app.task_queue.enqueue(
+                    "application.tasks.pretranslate_posts", selected)
+        except redis.exceptions.RedisError:
+            self.app.logger.warning("Could not queue pre-translation",
+                                    exc_info=True)
+            return 0
+        return len(selected)
@@ -0,0 +1,7 @@
+"""Settings for `rq worker -c application.rq_settings`.
+
+Importing the task module builds the app, and with it loads the language
+detector models, once in the worker process. Every job forked from it
+then starts with them in memory.
+"""
+import application.tasks  # noqa: F401
@@ -1,27 +1,381 @@
-from flask import current_app
+import base64, json, re, sqlite3
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from http import HTTPStatus
+from threading import Lock
+from time import monotonic, time
+
+from elasticsearch.exceptions import NotFoundError
+from flask import current_app, abort
 
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    apply_changes([(index, model.id, payload)])
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
-
-
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={"query": {"multi_match": {"query": query, "fields": ["*"]}},
-              "from": (page - 1) * per_page, "size": per_page})
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
-    return ids, search["hits"]["total"]["value"]
+    apply_changes([(index, model.id, None)])
+
+
+def encode_cursor(sort):
+    return base64.urlsafe_b64encode(json.dumps(sort).encode("utf-8")).decode(
+        "ascii")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        sort = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        abort(HTTPStatus.BAD_REQUEST)
+    if not isinstance(sort, list) or len(sort) != 2:
+        abort(HTTPStatus.BAD_REQUEST)
+    return sort
+
+
+def index_generation(index):
+    """Return the time of the last change to index seen by this cache."""
+    return current_app.search_cache.get(f"generation:{index}") or 0
+
+
+def _touch_generation(indices):
+    for index in indices:
+        current_app.search_cache.set(f"generation:{index}", time())
+
+
+def query_index(index, query, per_page, after=None):
+    """Return the ids of the per_page best matches of query that rank
+    after the cursor after, the total number of matches and the cursor of
+    the next page (None on the last page).
+
+    Results are cached for SEARCH_CACHE_TTL seconds under the index
+    generation, which changes whenever this process (or any process
+    sharing a Redis cache) changes the index.
+    """
+    if not current_app.search_backend:
+        return [], 0, None
+    key = f"{index}:{index_generation(index)}:{per_page}:{after or ''}:" \
+        f"{query}"
+    result = current_app.search_cache.get(key)
+    if result is None:
+        ids, total, sort = current_app.search_backend.search(
+            index, query, per_page, decode_cursor(after))
+        result = ids, total, encode_cursor(sort) if sort else None
+        current_app.search_cache.set(key, result)
+    return result
+
+
+def apply_changes(changes):
+    """Apply (index, id, payload) changes, deleting the documents whose
+    payload is None. Returns the error message of each (index, id) pair
+    that failed."""
+    if not current_app.search_backend or not changes:
+        return {}
+    failed = current_app.search_backend.apply(changes)
+    _touch_generation({index for index, _, _ in changes})
+    return failed
+
+
+def rebuild_index(alias, documents, batch_size=500, workers=4):
+    result = current_app.search_backend.rebuild(alias, documents, batch_size,
+                                                workers)
+    _touch_generation([alias])
+    return result
+
+
+class ElasticsearchBackend(object):
+    """Search backend storing documents in Elasticsearch.
+
+    Changes are queued in the search outbox and applied by the
+    `flask search consume` process, keeping ES off the request path.
+    """
+    queued = True
+    rebuild_suffix = "-next"
+
+    def __init__(self, client):
+        self.client = client
+
+    def search(self, index, query, per_page, after=None):
+        """Search with search_after, sorting on score and the id field
+        (documents are indexed with their id, as _id can't be sorted
+        on)."""
+        body = {"query": {"multi_match": {"query": query, "fields": ["*"],
+                                          "lenient": True}},
+                "size": per_page,
+                "sort": [{"_score": "desc"},
+                         {"id": {"order": "asc", "unmapped_type": "long"}}]}
+        if after:
+            body["search_after"] = after
+        search = self.client.search(index=index, body=body)
+        hits = search["hits"]["hits"]
+        ids = [int(hit["_id"]) for hit in hits]
+        sort = hits[-1]["sort"] if len(hits) == per_page else None
+        return ids, search["hits"]["total"]["value"], sort
+
+    def _bulk(self, changes, op="index"):
+        """Send (index, id, payload) changes in one bulk request, writing
+        documents with op, and return the error of each (index, id) pair
+        that failed.
+
+        With op "create" a document that is already there is left alone,
+        the conflict is not a failure."""
+        body = []
+        for index, id, payload in changes:
+            if payload is None:
+                body.append({"delete": {"_index": index, "_id": id}})
+            else:
+                body.append({op: {"_index": index, "_id": id}})
+                body.append({"id": id, **payload})
+        response = self.client.bulk(body=body)
+        if not response.get("errors"):
+            return {}
+        failed = {}
+        for (index, id, _), item in zip(changes, response["items"]):
+            result = next(iter(item.values()))
+            if result.get("error") and not (
+                    op == "create" and result.get("status") == 409):
+                current_app.logger.warning("Search index update failed: %s",
+                                           item)
+                failed[index, id] = json.dumps(result["error"])
+        return failed
+
+    def apply(self, changes):
+        """Send changes in one bulk request, returning the error of each
+        (index, id) pair Elasticsearch rejected.
+
+        While an index is being rebuilt, its changes are also written to
+        the new index so that they survive the alias swap.
+        """
+        rebuilding = {}
+        for index in {index for index, _, _ in changes}:
+            for name in self._aliased_indices(index + self.rebuild_suffix):
+                rebuilding[name] = index
+        failed = self._bulk(changes + [
+            (name, id, payload) for name, index in rebuilding.items()
+            for changed, id, payload in changes if changed == index])
+        return {(rebuilding.get(index, index), id): error
+                for (index, id), error in failed.items()}
+
+    def bulk_index(self, index, documents, batch_size=500, workers=4,
+                   op="index"):
+        """Send (id, payload) pairs to index through the bulk API.
+
+        documents is consumed in the calling thread, batch_size at a time,
+        and the batches are sent by a pool of workers with at most two
+        batches per worker in flight. Returns the number of indexed and
+        failed documents.
+        """
+        indexed = failed = 0
+        pending = set()
+
+        def send(batch):
+            errors = self._bulk(batch, op)
+            return len(batch) - len(errors), len(errors)
+
+        def collect(done):
+            nonlocal indexed, failed
+            for future in done:
+                ok, errors = future.result()
+                indexed += ok
+                failed += errors
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            batch = []
+            for id, payload in documents:
+                batch.append((index, id, payload))
+                if len(batch) < batch_size:
+                    continue
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(pool.submit(send, batch))
+                batch = []
+            if batch:
+                pending.add(pool.submit(send, batch))
+            collect(wait(pending)[0])
+        return indexed, failed
+
+    def _aliased_indices(self, alias):
+        try:
+            return list(self.client.indices.get_alias(name=alias))
+        except NotFoundError:
+            return []
+
+    def rebuild(self, alias, documents, batch_size=500, workers=4):
+        """Build a new versioned index from documents and swap alias over to
+        it.
+
+        Searches keep using the old index until the alias is moved in a
+        single update_aliases call, after which the old indices are
+        dropped. A plain index named alias (from before aliases were used)
+        is replaced in the same call.
+
+        The new index carries the <alias>-next alias while it is built, so
+        apply() writes changes made meanwhile to both indices. Documents
+        are loaded with create, which keeps a newer copy written by apply()
+        rather than overwriting it with the one read at the start.
+        """
+        started = monotonic()
+        index = f"{alias}-{datetime.utcnow():%Y%m%d%H%M%S%f}"
+        next_alias = alias + self.rebuild_suffix
+        self.client.indices.create(index=index, body={
+            "settings": {"index": {"refresh_interval": "-1"}},
+            "aliases": {next_alias: {}}})
+        try:
+            indexed, failed = self.bulk_index(index, documents, batch_size,
+                                              workers, op="create")
+            self.client.indices.put_settings(index=index, body={
+                "index": {"refresh_interval": None}})
+            self.client.indices.refresh(index=index)
+            old = self._aliased_indices(alias)
+            actions = [{"add": {"index": index, "alias": alias}},
+                       {"remove": {"index": index, "alias": next_alias}}]
+            if not old and self.client.indices.exists(index=alias):
+                actions.insert(0, {"remove_index": {"index": alias}})
+            actions += [{"remove": {"index": name, "alias": alias}}
+                        for name in old]
+            self.client.indices.update_aliases(body={"actions": actions})
+        except BaseException:
+            self.client.indices.delete(index=index)
+            raise
+        for name in old:
+            self.client.indices.delete(index=name)
+        return {"index": index, "indexed": indexed, "failed": failed,
+                "seconds": monotonic() - started}
+
+
+class SQLiteSearchBackend(object):
+    """Search backend keeping one SQLite FTS5 table per index in a local
+    database file, ranked with BM25.
+
+    Meant for development and single-host deployments without
+    Elasticsearch. Writes are cheap, so changes are applied right after the
+    commit that made them instead of going through the search outbox.
+    """
+    queued = False
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None)
+        return self._connection
+
+    def _exists(self, table):
+        return self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (table,)
+        ).fetchone() is not None
+
+    def _create(self, table, fields):
+        columns = ", ".join(f'"{field}"' for field in fields)
+        self.connection.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{table}" USING '
+            f"fts5({columns}, tokenize='porter unicode61')")
+
+    def _write(self, table, changes):
+        for id, payload in changes:
+            if payload is None:
+                if self._exists(table):
+                    self.connection.execute(
+                        f'DELETE FROM "{table}" WHERE rowid = ?', (id,))
+                continue
+            self._create(table, payload)
+            columns = ", ".join(f'"{field}"' for field in payload)
+            values = ", ".join("?" * len(payload))
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO "{table}" (rowid, {columns}) '
+                f"VALUES (?, {values})", (id, *payload.values()))
+
+    @staticmethod
+    def match_expression(query):
+        """Turn free text into an FTS5 query matching any of its words, as
+        the multi_match query of the Elasticsearch backend does."""
+        words = re.findall(r"\w+", query)
+        return " OR ".join(f'"{word}"' for word in words)
+
+    def search(self, index, query, per_page, after=None):
+        """Search ordered by BM25 rank and rowid, continuing after the
+        (rank, rowid) cursor after."""
+        expression = self.match_expression(query)
+        with self._lock:
+            if not expression or not self._exists(index):
+                return [], 0, None
+            total = self.connection.execute(
+                f'SELECT count(*) FROM "{index}" WHERE "{index}" MATCH ?',
+                (expression,)).fetchone()[0]
+            sql = f'SELECT rowid, rank FROM "{index}" WHERE "{index}" MATCH ?'
+            params = [expression]
+            if after:
+                sql += " AND (rank > ? OR (rank = ? AND rowid > ?))"
+                params += [after[0], after[0], after[1]]
+            rows = self.connection.execute(
+                sql + " ORDER BY rank, rowid LIMIT ?",
+                (*params, per_page)).fetchall()
+        sort = [rows[-1][1], rows[-1][0]] if len(rows) == per_page else None
+        return [row[0] for row in rows], total, sort
+
+    def apply(self, changes):
+        with self._lock:
+            self.connection.execute("BEGIN")
+            try:
+                for index, id, payload in changes:
+                    self._write(index, [(id, payload)])
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        return {}
+
+    def rebuild(self, alias, documents, batch_size=500, workers=4):
+        """Load documents into a new table and rename it over the old one
+        in a single transaction. workers is ignored, SQLite has a single
+        writer."""
+        started = monotonic()
+        table = f"{alias}__rebuild"
+        indexed = 0
+        with self._lock:
+            self.connection.execute(f'DROP TABLE IF EXISTS "{table}"')
+            batch = []
+            for document in documents:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    self._load(table, batch)
+                    indexed += len(batch)
+                    batch = []
+            self._load(table, batch)
+            indexed += len(batch)
+            self.connection.execute("BEGIN")
+            self.connection.execute(f'DROP TABLE IF EXISTS "{alias}"')
+            if self._exists(table):
+                self.connection.execute(
+                    f'ALTER TABLE "{table}" RENAME TO "{alias}"')
+            self.connection.execute("COMMIT")
+        return {"index": alias, "indexed": indexed, "failed": 0,
+                "seconds": monotonic() - started}
+
+    def _load(self, table, batch):
+        if not batch:
+            return
+        self.connection.execute("BEGIN")
+        self._write(table, batch)
+        self.connection.execute("COMMIT")
+
+
+def make_search_backend(app):
+    """Build the backend selected by the SEARCH_BACKEND setting of app."""
+    backend = app.config["SEARCH_BACKEND"]
+    if backend == "elasticsearch" and app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    if backend == "sqlite":
+        return SQLiteSearchBackend(app.config["SEARCH_INDEX_PATH"])
+    return None
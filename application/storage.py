@@ -0,0 +1,58 @@
+import os, shutil, time
+
+
+class LocalStorage(object):
+    """Stores artifacts as files below root, addressed by relative keys.
+
+    Other backends (e.g. object storage) need to provide the same save,
+    open, path, exists, delete and cleanup methods.
+
+    Sharded exports write their chunks from one worker and read them back
+    in another, so with EXPORT_SHARD_SIZE set root must be shared by all
+    task workers (e.g. a network volume), or a shared backend used.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Invalid storage key {key!r}")
+        return path
+
+    def save(self, key, fileobj):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(path + ".part", path)
+        return key
+
+    def open(self, key):
+        """Return a binary file object to read the artifact from."""
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self, max_age):
+        """Delete artifacts older than max_age seconds, returning their
+        keys."""
+        cutoff = time.time() - max_age
+        removed = []
+        for directory, _, files in os.walk(self.root, topdown=False):
+            for name in files:
+                path = os.path.join(directory, name)
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed.append(os.path.relpath(path, self.root))
+            if directory != self.root and not os.listdir(directory):
+                os.rmdir(directory)
+        return removed
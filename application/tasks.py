@@ -1,64 +1,358 @@
-import time, json, sys
+import codecs, gzip, tempfile, time, json, sys, uuid, rq
 
-from flask import render_template
+from flask import render_template, current_app
 
 from rq import get_current_job
+from urllib.parse import urlsplit
 
 from application import create_app, db
 from application.models.task import Task
 from application.models.user import User
 from application.models.post import Post
 from application.email import send_mail
+from application.language import detect_language
+from application.translate import translate_many
 
 
 app = create_app()
 app.app_context().push()
 
 
-def _set_task_progress(progress):
-    job = get_current_job()
+# (progress, monotonic time) of the last progress write of each task
+_last_progress = {}
+
+
+def _set_task_progress(progress, force=False, task_id=None, failed=False):
+    """Record the progress of the current job, or of the task with id
+    task_id when reporting on behalf of a parent job.
+
+    Writes are coalesced: an update is skipped unless progress moved by at
+    least TASK_PROGRESS_STEP percent and TASK_PROGRESS_INTERVAL seconds have
+    passed since the last write. The first update, completion and forced
+    updates (e.g. on failure) are always written.
+    """
+    if task_id is None:
+        job = get_current_job()
+        if not job:
+            return
+        task_id = job.get_id()
+    else:
+        job = None
+    now = time.monotonic()
+    last = _last_progress.get(task_id)
+    if not force and not failed and progress < 100 and last is not None and (
+            progress - last[0] < current_app.config["TASK_PROGRESS_STEP"]
+            or now - last[1] < current_app.config["TASK_PROGRESS_INTERVAL"]):
+        return
+    if progress >= 100:
+        _last_progress.pop(task_id, None)
+    else:
+        _last_progress[task_id] = (progress, now)
+    task = Task.query.get(task_id)
+    job = job or task.get_rq_job()
     if job:
         job.meta["progress"] = progress
+        if failed:
+            job.meta["failed"] = True
         job.save_meta()
-        task = Task.query.get(job.get_id())
-        task.user.add_notification("task_progress",{
-                                    "task_id": job.get_id(),
-                                    "progress": progress})
-        if progress >= 100:
-            task.complete = True
+    task.user.add_notification("task_progress",{
+                                "task_id": task_id,
+                                "progress": progress})
+    if progress >= 100:
+        task.complete = True
+    db.session.commit()
+
+
+def _after_key(key):
+    created_on, id = key
+    return db.or_(Post.created_on > created_on,
+                  db.and_(Post.created_on == created_on, Post.id > id))
+
+
+def iter_posts(user_id, batch_size, start=None, end=None):
+    """Yield (body, created_on) of a user's posts oldest first, optionally
+    limited to the (created_on, id) keys after start and up to end.
+
+    Rows are fetched in keyset batches rather than from one long-running
+    cursor, so callers can commit (e.g. progress updates) while iterating.
+    """
+    last = start
+    while True:
+        query = db.session.query(Post.body, Post.created_on, Post.id).filter(
+            Post.user_id == user_id)
+        if last is not None:
+            query = query.filter(_after_key(last))
+        if end is not None:
+            query = query.filter(db.not_(_after_key(end)))
+        batch = query.order_by(Post.created_on.asc(), Post.id.asc()).limit(
+            batch_size).all()
+        for body, created_on, _ in batch:
+            yield body, created_on
+        if len(batch) < batch_size:
+            return
+        last = batch[-1][1:]
+
+
+def post_records(posts):
+    """Serialize (body, created_on) rows to one JSON object string each."""
+    for body, created_on in posts:
+        yield json.dumps({"body": body,
+                          "timestamp": created_on.isoformat() + "Z"})
+
+
+def write_records(records, fileobj, format="json", progress=None):
+    """Stream JSON object strings into the text file fileobj as a JSON
+    document or NDJSON, calling progress with the running count."""
+    count = 0
+    if format != "ndjson":
+        fileobj.write('{"posts": [')
+    for record in records:
+        if format == "ndjson":
+            fileobj.write(record)
+            fileobj.write("\n")
+        else:
+            fileobj.write(",\n" if count else "\n")
+            fileobj.write(record)
+        count += 1
+        if progress:
+            progress(count)
+    if format != "ndjson":
+        fileobj.write("\n]}\n")
+    return count
+
+
+def write_posts(posts, fileobj, format="json", progress=None):
+    return write_records(post_records(posts), fileobj, format, progress)
+
+
+def export_records_file(records, format="json", compress=False,
+                        progress=None):
+    """Write records to a spooled temporary file, gzipped if compress is set.
+
+    Returns the file rewound to its start and the number of records.
+    """
+    spool = tempfile.SpooledTemporaryFile(
+        max_size=current_app.config["EXPORT_SPOOL_SIZE"])
+    raw = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    # not io.TextIOWrapper: before Python 3.11 SpooledTemporaryFile lacks
+    # the readable/writable/seekable methods it needs
+    text = codecs.getwriter("utf-8")(raw)
+    count = write_records(records, text, format, progress)
+    if compress:
+        raw.close()
+    spool.seek(0)
+    return spool, count
+
+
+def export_posts_file(posts, format="json", compress=False, progress=None):
+    return export_records_file(post_records(posts), format, compress,
+                               progress)
+
+
+def export_filename(format, compress):
+    return "posts." + ("ndjson" if format == "ndjson" else "json") + \
+        (".gz" if compress else "")
+
+
+def _external_url(base_url, endpoint, **values):
+    """Build an absolute URL for endpoint outside of a request."""
+    parts = urlsplit(base_url or "http://localhost/")
+    adapter = app.url_map.bind(parts.netloc, script_name=parts.path or "/",
+                               url_scheme=parts.scheme)
+    return adapter.build(endpoint, values, force_external=True)
+
+
+def _deliver_export(user, task_id, archive, base_url):
+    """Store the archive and send its download link to the user."""
+    format = app.config["EXPORT_FORMAT"]
+    compress = app.config["EXPORT_COMPRESS"]
+    with archive:
+        key = app.export_storage.save(
+            f"{user.id}/{task_id}/{export_filename(format, compress)}",
+            archive)
+    task = Task.query.get(task_id)
+    if task:
+        task.artifact = key
         db.session.commit()
+    url = _external_url(base_url, "main.download_export", task_id=task_id)
+    send_mail("[Microblog] Your blog posts",
+            sender=app.config["ADMINS"][0], recipients=[user.email],
+            body=render_template("email/export_posts.txt", user=user,
+                                 url=url),
+            html=render_template("email/export_posts.html", user=user,
+                                 url=url),
+            sync=True)
 
 
-def export_posts(user_id):
+def export_posts(user_id, base_url=None):
+    job = get_current_job()
+    task_id = job.get_id() if job else uuid.uuid4().hex
     try:
-        # read user posts from database
+        # stream user posts from database
         user = User.query.get(user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.created_on.asc()):
-            data.append({'body': post.body,
-                         'timestamp': post.created_on.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-
-        # send email with data to user
-        send_mail("[Microblog] Your blog posts",
-                sender=app.config["ADMINS"][0], recipients=[user.email],
-                body=render_template("email/export_posts.txt", user=user),
-                html=render_template("email/export_posts.html",
-                                          user=user),
-                attachments=[("posts.json", "application/json",
-                              json.dumps({"posts": data}, indent=4))],
-                sync=True)
+        shard_size = app.config["EXPORT_SHARD_SIZE"]
+        if job and shard_size and user.post_count > shard_size:
+            return _export_posts_sharded(user, task_id, shard_size, base_url)
+        total_posts = user.post_count or 1
+        posts = iter_posts(user.id, app.config["EXPORT_BATCH_SIZE"])
+        archive, _ = export_posts_file(
+            posts, app.config["EXPORT_FORMAT"], app.config["EXPORT_COMPRESS"],
+            progress=lambda i: _set_task_progress(
+                min(100 * i // total_posts, 99)))
+        _deliver_export(user, task_id, archive, base_url)
     except:
         app.logger.error("Unhandled exception", exc_info=sys.exc_info())
-    finally:
+        _set_task_progress(100, failed=True)
+    else:
         _set_task_progress(100)
 
 
+def _shard_bounds(user_id, shard_size):
+    """Split a user's posts into (start, end] key ranges of shard_size."""
+    bounds = []
+    last = None
+    while True:
+        query = db.session.query(Post.created_on, Post.id).filter(
+            Post.user_id == user_id)
+        if last is not None:
+            query = query.filter(_after_key(last))
+        key = query.order_by(Post.created_on.asc(), Post.id.asc()).offset(
+            shard_size - 1).first()
+        if key is None:
+            bounds.append((last, None))
+            return bounds
+        bounds.append((last, tuple(key)))
+        last = tuple(key)
+
+
+def _chunk_key(user_id, task_id, index):
+    return f"{user_id}/{task_id}/chunks/{index:05d}.ndjson"
+
+
+def _chunks_done_key(task_id):
+    return f"microblog:export:{task_id}:chunks_done"
+
+
+def _delete_chunks(user_id, task_id, total):
+    for index in range(total):
+        app.export_storage.delete(_chunk_key(user_id, task_id, index))
+
+
+def _export_posts_sharded(user, task_id, shard_size, base_url):
+    """Fan the export out to one chunk job per shard and a merge job that
+    runs once all chunks have finished."""
+    bounds = _shard_bounds(user.id, shard_size)
+    app.redis.delete(_chunks_done_key(task_id))
+    chunks = [app.task_queue.enqueue("application.tasks.export_posts_chunk",
+                                     user.id, task_id, index, len(bounds),
+                                     start, end)
+              for index, (start, end) in enumerate(bounds)]
+    app.task_queue.enqueue("application.tasks.merge_export_chunks", user.id,
+                           task_id, len(bounds), base_url, depends_on=chunks)
+
+
+def _fail_sharded_export(user_id, task_id, total):
+    """Mark the export failed, drop its chunks and its pending merge job,
+    which RQ would otherwise keep deferred forever."""
+    _set_task_progress(100, task_id=task_id, failed=True)
+    _delete_chunks(user_id, task_id, total)
+    app.redis.delete(_chunks_done_key(task_id))
+    job = get_current_job()
+    for dependent_id in (job.dependent_ids if job else []):
+        try:
+            rq.job.Job.fetch(dependent_id, connection=app.redis).delete()
+        except rq.exceptions.NoSuchJobError:
+            pass
+
+
+def export_posts_chunk(user_id, task_id, index, total, start, end):
+    try:
+        task = Task.query.get(task_id)
+        if task is None or task.complete:
+            # another chunk failed and the export was given up
+            return
+        records = post_records(
+            iter_posts(user_id, app.config["EXPORT_BATCH_SIZE"], start, end))
+        chunk, _ = export_records_file(records, format="ndjson")
+        with chunk:
+            app.export_storage.save(_chunk_key(user_id, task_id, index),
+                                    chunk)
+        pipe = app.redis.pipeline()
+        pipe.incr(_chunks_done_key(task_id))
+        pipe.expire(_chunks_done_key(task_id), app.config["EXPORT_TTL"])
+        done, _ = pipe.execute()
+        db.session.expire(task)
+        if task.complete:
+            app.export_storage.delete(_chunk_key(user_id, task_id, index))
+            return
+        _set_task_progress(min(100 * done // (total + 1), 99),
+                           task_id=task_id)
+    except:
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+        _fail_sharded_export(user_id, task_id, total)
+        raise
+
+
+def _chunk_records(user_id, task_id, total):
+    for index in range(total):
+        with app.export_storage.open(
+                _chunk_key(user_id, task_id, index)) as f:
+            for line in codecs.getreader("utf-8")(f):
+                yield line.rstrip("\n")
+
+
+def merge_export_chunks(user_id, task_id, total, base_url=None):
+    try:
+        user = User.query.get(user_id)
+        task = Task.query.get(task_id)
+        if task is not None and task.complete:
+            _delete_chunks(user_id, task_id, total)
+            return
+        archive, _ = export_records_file(
+            _chunk_records(user_id, task_id, total),
+            app.config["EXPORT_FORMAT"], app.config["EXPORT_COMPRESS"])
+        _deliver_export(user, task_id, archive, base_url)
+        _delete_chunks(user_id, task_id, total)
+        app.redis.delete(_chunks_done_key(task_id))
+    except:
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+        _delete_chunks(user_id, task_id, total)
+        _set_task_progress(100, task_id=task_id, failed=True)
+    else:
+        _set_task_progress(100, task_id=task_id)
+
+
+def cleanup_exports():
+    """Delete export archives, and chunk files of sharded exports that
+    never merged, older than EXPORT_TTL seconds."""
+    return Task.cleanup_artifacts(app.export_storage, app.config["EXPORT_TTL"])
+
+
+def detect_post_language(post_ids):
+    """Fill in the language of posts saved without one."""
+    posts = Post.query.filter(Post.id.in_(post_ids),
+                              Post.language.is_(None)).all()
+    for post in posts:
+        post.language = detect_language(app.language_detector, post.body)
+    db.session.commit()
+    app.pretranslator.enqueue([(post.id, post.body, post.language)
+                               for post in posts
+                               if app.pretranslator.wants_fan_out(post)])
+
+
+def pretranslate_posts(post_ids):
+    """Translate posts into the configured languages, filling the shared
+    translation cache."""
+    posts = db.session.query(Post.body, Post.language).filter(
+        Post.id.in_(post_ids)).all()
+    for language in app.config["LANGUAGES"]:
+        items = [(body, source) for body, source in posts
+                 if source and source != language]
+        if items:
+            translate_many(items, language)
+
+
 def export(seconds):
     job = get_current_job()
     print("Starting task")
@@ -1,22 +1,131 @@
-import json
+import hashlib
 import requests
 
+from time import time
+
 from flask import current_app
 from flask_babel import _
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-def translate(text, source_language, dest_language):
-    if "MS_TRANSLATOR_KEY" not in current_app.config or \
-            not current_app.config["MS_TRANSLATOR_KEY"]:
-        print(current_app.config["MS_TRANSLATOR_KEY"])
-        return _("Error: the translation service is not configured.")
+class TranslationError(Exception):
+    pass
+
+
+def make_session(app):
+    """Build the pooled HTTP session used to call the translator."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=app.config["TRANSLATOR_POOL_SIZE"],
+                          max_retries=Retry(connect=2, read=0,
+                                            backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def cache_key(text, source_language, dest_language):
+    return hashlib.sha256(
+        f"{source_language}\x00{dest_language}\x00{text}".encode("utf-8")
+    ).hexdigest()
+
+
+def request_translations(texts, source_language, dest_language):
+    """Translate texts with one translator request, raising
+    TranslationError if the request fails."""
     auth = {
         "Ocp-Apim-Subscription-Key": current_app.config["MS_TRANSLATOR_KEY"],
         "Ocp-Apim-Subscription-Region": current_app.config["MS_TRANSLATOR_REGION"]}
-    r = requests.post(
-        "https://api.cognitive.microsofttranslator.com"
-        "/translate?api-version=3.0&from={}&to={}".format(
-            source_language, dest_language), headers=auth, json=[{"Text": text}])
+    try:
+        r = current_app.translator.post(
+            current_app.config["MS_TRANSLATOR_URL"] + "/translate",
+            params={"api-version": "3.0", "from": source_language,
+                    "to": dest_language},
+            headers=auth, json=[{"Text": text} for text in texts],
+            timeout=current_app.config["TRANSLATOR_TIMEOUT"])
+    except requests.RequestException as e:
+        raise TranslationError(str(e))
     if r.status_code != 200:
-        return _("Error: the translation service failed.")
-    return r.json()[0]["translations"][0]["text"]
+        raise TranslationError(f"translator returned {r.status_code}")
+    return [item["translations"][0]["text"] for item in r.json()]
+
+
+def cached_translation(key):
+    """Return the cached translation for key, False for a cached failure
+    or None if nothing is cached."""
+    entry = current_app.translation_cache.get(key)
+    if entry is None:
+        return None
+    text, expires = entry
+    if expires is not None and expires < time():
+        return None
+    return text
+
+
+def cache_translation(key, text):
+    if text is False:
+        ttl = current_app.config["TRANSLATION_ERROR_TTL"]
+        current_app.translation_cache.set(key, (False, time() + ttl), ttl)
+    else:
+        current_app.translation_cache.set(key, (text, None))
+
+
+def _chunks(pending):
+    """Split (key, text) pairs into runs within the translator's
+    per-request limits."""
+    chunk, size = [], 0
+    for key, text in pending:
+        if chunk and (len(chunk) >= current_app.config["TRANSLATOR_BATCH_SIZE"]
+                      or size + len(text) >
+                      current_app.config["TRANSLATOR_BATCH_CHARS"]):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((key, text))
+        size += len(text)
+    if chunk:
+        yield chunk
+
+
+def translate_many(items, dest_language):
+    """Translate (text, source_language) pairs to dest_language.
+
+    Repeated pairs are translated once, cached translations are served
+    locally and the rest is sent upstream in chunks, one language pair at
+    a time. Returns the translations (or error messages) in item order.
+    """
+    if "MS_TRANSLATOR_KEY" not in current_app.config or \
+            not current_app.config["MS_TRANSLATOR_KEY"]:
+        return [_("Error: the translation service is not configured.")] * \
+            len(items)
+    keys = [cache_key(text, source_language, dest_language)
+            for text, source_language in items]
+    translations = {}
+    misses = {}
+    for key, (text, source_language) in zip(keys, items):
+        if key in translations or key in misses.get(source_language, {}):
+            continue
+        translation = cached_translation(key)
+        if translation is None:
+            misses.setdefault(source_language, {})[key] = text
+        else:
+            translations[key] = translation
+    for source_language, pending in misses.items():
+        for chunk in _chunks(pending.items()):
+            try:
+                results = request_translations(
+                    [text for key, text in chunk], source_language,
+                    dest_language)
+            except TranslationError:
+                current_app.logger.warning("Translation failed",
+                                           exc_info=True)
+                results = [False] * len(chunk)
+            for (key, text), translation in zip(chunk, results):
+                cache_translation(key, translation)
+                translations[key] = translation
+    return [_("Error: the translation service failed.")
+            if translations[key] is False else translations[key]
+            for key in keys]
+
+
+def translate(text, source_language, dest_language):
+    return translate_many([(text, source_language)], dest_language)[0]
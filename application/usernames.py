@@ -0,0 +1,202 @@
+import json
+import redis
+
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic
+
+from application import db
+
+
+def _entry(username):
+    # entries sort case-insensitively and keep the original spelling
+    return f"{username.lower()}\x00{username}"
+
+
+class LocalUsernameIndex(object):
+    """Sorted list of usernames for prefix lookups, loaded from the user
+    table on first use and updated with the changes committed by this
+    process.
+
+    Changes committed by other processes are picked up through a
+    generation counter in Redis, bumped on every change and checked at
+    most every USERNAME_INDEX_SYNC_INTERVAL seconds. Each change is also
+    logged under its generation, keeping the last USERNAME_INDEX_LOG_SIZE,
+    so a process that fell behind applies the changes it missed and only
+    reloads the list when they were trimmed from the log. An interval of
+    0 turns the check off.
+    """
+    generation_key = "microblog:usernames:generation"
+    log_key = "microblog:usernames:log"
+
+    def __init__(self, app):
+        self.app = app
+        self.sync_interval = app.config["USERNAME_INDEX_SYNC_INTERVAL"]
+        self.log_size = app.config["USERNAME_INDEX_LOG_SIZE"]
+        self._entries = None
+        self._generation = None
+        self._checked_at = monotonic()
+        self._lock = Lock()
+
+    def _load(self):
+        from application.models.user import User
+        with db.get_engine(self.app).connect() as connection:
+            rows = connection.execute(db.select([User.username]).where(
+                User.username.isnot(None)))
+            return sorted(_entry(row[0]) for row in rows)
+
+    def _current_generation(self):
+        if not self.sync_interval:
+            return None
+        try:
+            return int(self.app.redis.get(self.generation_key) or 0)
+        except redis.exceptions.RedisError:
+            self.app.logger.warning("Could not read username index generation",
+                                    exc_info=True)
+            return self._generation
+
+    def rebuild(self):
+        generation = self._current_generation()
+        entries = self._load()
+        with self._lock:
+            self._entries = entries
+            self._generation = generation
+            self._checked_at = monotonic()
+        return len(entries)
+
+    def warm(self):
+        """Load the list ahead of the first lookup, e.g. at worker start."""
+        if self._entries is None:
+            self.rebuild()
+
+    def _apply(self, changes):
+        # replayed changes may already be applied, so both steps are
+        # no-ops when the entry is already gone or there
+        for old, new in changes:
+            if old is not None:
+                i = bisect_left(self._entries, _entry(old))
+                if i < len(self._entries) and self._entries[i] == _entry(old):
+                    del self._entries[i]
+            if new is not None:
+                i = bisect_left(self._entries, _entry(new))
+                if i == len(self._entries) or self._entries[i] != _entry(new):
+                    self._entries.insert(i, _entry(new))
+
+    def _log(self, changes):
+        def publish(pipe):
+            generation = int(pipe.get(self.generation_key) or 0) + 1
+            pipe.multi()
+            pipe.set(self.generation_key, generation)
+            pipe.zadd(self.log_key,
+                      {json.dumps([generation, changes]): generation})
+            pipe.zremrangebyrank(self.log_key, 0, -self.log_size - 1)
+            return generation
+        return self.app.redis.transaction(publish, self.generation_key,
+                                          value_from_callable=True)
+
+    def update(self, changes):
+        """Apply (old, new) username pairs, either of which may be None."""
+        with self._lock:
+            if self._entries is not None:
+                self._apply(changes)
+        if self.sync_interval:
+            generation = self._log(changes)
+            with self._lock:
+                # skip the replay when no other process changed names since
+                if self._generation == generation - 1:
+                    self._generation = generation
+
+    def _sync(self):
+        if not self.sync_interval or \
+                monotonic() - self._checked_at < self.sync_interval:
+            return
+        self._checked_at = monotonic()
+        generation = self._current_generation()
+        if generation == self._generation:
+            return
+        if self._generation is None or generation < self._generation:
+            self.rebuild()
+            return
+        try:
+            logged = self.app.redis.zrangebyscore(
+                self.log_key, self._generation + 1, generation)
+        except redis.exceptions.RedisError:
+            self.app.logger.warning("Could not read username index log",
+                                    exc_info=True)
+            return
+        if len(logged) != generation - self._generation:
+            # the changes we missed were trimmed from the log
+            self.rebuild()
+            return
+        with self._lock:
+            for entry in logged:
+                self._apply(json.loads(entry)[1])
+            self._generation = generation
+
+    def complete(self, prefix, limit=10):
+        if self._entries is None:
+            self.rebuild()
+        else:
+            self._sync()
+        prefix = prefix.lower()
+        with self._lock:
+            i = bisect_left(self._entries, prefix)
+            matches = self._entries[i:i + limit]
+        return [entry.split("\x00", 1)[1] for entry in matches
+                if entry.startswith(prefix)]
+
+
+class RedisUsernameIndex(object):
+    """Usernames kept in a Redis sorted set with equal scores, looked up
+    with ZRANGEBYLEX and shared by all processes."""
+    key = "microblog:usernames"
+
+    def __init__(self, app):
+        self.app = app
+        self.redis = app.redis
+
+    def rebuild(self, batch_size=10000):
+        from application.models.user import User
+        count = 0
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(self.key + ":rebuild")
+        with db.get_engine(self.app).connect() as connection:
+            rows = connection.execution_options(stream_results=True).execute(
+                db.select([User.username]).where(User.username.isnot(None)))
+            for row in rows:
+                pipe.zadd(self.key + ":rebuild", {_entry(row[0]): 0})
+                count += 1
+                if count % batch_size == 0:
+                    pipe.execute()
+        pipe.execute()
+        if count:
+            self.redis.rename(self.key + ":rebuild", self.key)
+        else:
+            self.redis.delete(self.key)
+        return count
+
+    def warm(self):
+        if not self.redis.exists(self.key):
+            self.rebuild()
+
+    def update(self, changes):
+        pipe = self.redis.pipeline()
+        for old, new in changes:
+            if old is not None:
+                pipe.zrem(self.key, _entry(old))
+            if new is not None:
+                pipe.zadd(self.key, {_entry(new): 0})
+        pipe.execute()
+
+    def complete(self, prefix, limit=10):
+        prefix = prefix.lower().encode("utf-8")
+        matches = self.redis.zrangebylex(self.key, b"[" + prefix,
+                                         b"[" + prefix + b"\xff", 0, limit)
+        return [match.decode("utf-8").split("\x00", 1)[1]
+                for match in matches]
+
+
+def make_username_index(app):
+    if app.config["USERNAME_INDEX_REDIS"]:
+        return RedisUsernameIndex(app)
+    return LocalUsernameIndex(app)
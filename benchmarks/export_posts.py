@@ -0,0 +1,60 @@
+"""Export a large synthetic post history and report time and peak RSS.
+
+    python benchmarks/export_posts.py [posts] [--ndjson] [--gzip]
+"""
+import os, sys, resource, tempfile, time
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import create_app, db
+from application.models.post import Post
+from application.models.user import User
+from application.tasks import export_posts_file, iter_posts
+from config import Config
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    total = int(args[0]) if args else 1000000
+    format = "ndjson" if "--ndjson" in sys.argv else "json"
+    compress = "--gzip" in sys.argv
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{path}"
+        LOG_TO_STDOUT = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        user = User(username="bench", email="bench@example.com")
+        user.save()
+        start = datetime.utcnow()
+        for offset in range(0, total, 10000):
+            db.session.execute(Post.__table__.insert(), [
+                {"body": f"synthetic post number {i}", "user_id": user.id,
+                 "created_on": start + timedelta(seconds=i)}
+                for i in range(offset, min(offset + 10000, total))])
+        db.session.commit()
+        print(f"seeded {total} posts, peak RSS {peak_rss_mb():.1f} MB")
+
+        posts = iter_posts(user.id, app.config["EXPORT_BATCH_SIZE"])
+        started = time.perf_counter()
+        archive, count = export_posts_file(posts, format, compress)
+        elapsed = time.perf_counter() - started
+        archive.seek(0, os.SEEK_END)
+        print(f"exported {count} posts as {format}{' gzip' if compress else ''}"
+              f" in {elapsed:.2f}s ({count / elapsed:.0f} posts/s), "
+              f"{archive.tell() / 1024 / 1024:.1f} MB, "
+              f"peak RSS {peak_rss_mb():.1f} MB")
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compare the language detectors on a fixed corpus of post-sized texts.
+
+    python benchmarks/language.py [rounds]
+
+Reports model load time, accuracy and mean/p99 per-post latency of each
+detector in application.language.DETECTORS.
+"""
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application.language import DETECTORS, detect_language
+
+CORPUS = [
+    ("en", "Just finished reading a great book about the history of tea."),
+    ("en", "Does anyone know a good place to eat near the train station?"),
+    ("en", "The weather has been terrible all week, I miss the sunshine."),
+    ("en", "Our team shipped the new release today, thanks everyone!"),
+    ("en", "ok"),
+    ("es", "Acabo de terminar un libro muy bueno sobre la historia del té."),
+    ("es", "¿Alguien conoce un buen sitio para comer cerca de la estación?"),
+    ("es", "El tiempo ha sido horrible toda la semana, echo de menos el sol."),
+    ("es", "Nuestro equipo publicó la nueva versión hoy, ¡gracias a todos!"),
+    ("es", "hola"),
+    ("fr", "Je viens de finir un très bon livre sur l'histoire du thé."),
+    ("fr", "Quelqu'un connaît un bon endroit pour manger près de la gare ?"),
+    ("fr", "Il a fait un temps horrible toute la semaine, le soleil me manque."),
+    ("fr", "Notre équipe a publié la nouvelle version aujourd'hui, merci !"),
+    ("de", "Ich habe gerade ein tolles Buch über die Geschichte des Tees gelesen."),
+    ("de", "Kennt jemand ein gutes Restaurant in der Nähe des Bahnhofs?"),
+    ("de", "Das Wetter war die ganze Woche schrecklich, ich vermisse die Sonne."),
+    ("de", "Unser Team hat heute die neue Version veröffentlicht, danke euch!"),
+    ("it", "Ho appena finito un bel libro sulla storia del tè."),
+    ("it", "Qualcuno conosce un buon posto dove mangiare vicino alla stazione?"),
+    ("it", "Il tempo è stato orribile tutta la settimana, mi manca il sole."),
+    ("it", "Il nostro team ha pubblicato la nuova versione oggi, grazie a tutti!"),
+    ("pt", "Acabei de ler um livro muito bom sobre a história do chá."),
+    ("pt", "Alguém conhece um bom lugar para comer perto da estação?"),
+    ("pt", "O tempo esteve horrível a semana toda, tenho saudades do sol."),
+    ("pt", "A nossa equipa lançou a nova versão hoje, obrigado a todos!"),
+    ("nl", "Ik heb net een geweldig boek over de geschiedenis van thee gelezen."),
+    ("nl", "Weet iemand een goede plek om te eten in de buurt van het station?"),
+    ("nl", "Het weer was de hele week verschrikkelijk, ik mis de zon."),
+    ("nl", "Ons team heeft vandaag de nieuwe versie uitgebracht, bedankt!"),
+]
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for name, detector_class in DETECTORS.items():
+        detector = detector_class()
+        started = time.perf_counter()
+        detector.load()
+        load = time.perf_counter() - started
+        correct = sum(detect_language(detector, text) == language
+                      for language, text in CORPUS)
+        timings = []
+        for _ in range(rounds):
+            for _, text in CORPUS:
+                started = time.perf_counter()
+                detect_language(detector, text)
+                timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"{name}: load {load * 1000:.0f}ms, accuracy "
+              f"{correct}/{len(CORPUS)} ({100 * correct / len(CORPUS):.0f}%), "
+              f"mean {sum(timings) / len(timings):.3f}ms, "
+              f"p99 {timings[int(len(timings) * 0.99) - 1]:.3f}ms per post")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Measure outbound mail throughput against a local SMTP server.
+
+    python -m aiosmtpd -n -l localhost:8025 &
+    MAIL_SERVER=localhost MAIL_PORT=8025 python benchmarks/mail.py [messages]
+
+Sends a burst of messages the old way, one thread and one SMTP connection
+per message, and through the pooled MailDispatcher, and reports messages
+per second and the peak number of threads of each.
+"""
+import os, sys, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_mail import Message
+
+from application import create_app
+from config import Config
+
+
+class BenchConfig(Config):
+    LOG_TO_STDOUT = True
+
+
+def burst(send, total):
+    peak = threading.active_count()
+    started = time.perf_counter()
+    for i in range(total):
+        send(Message("Reset your password", sender="admin@example.com",
+                     recipients=[f"user{i}@example.com"],
+                     body="Follow the link to reset your password."))
+        peak = max(peak, threading.active_count())
+    return started, peak
+
+
+def report(name, total, started, peak):
+    elapsed = time.perf_counter() - started
+    print(f"{name}: {total} messages in {elapsed:.2f}s, "
+          f"{total / elapsed:.0f} msg/s, peak {peak} threads")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    app = create_app(BenchConfig)
+    state = app.extensions["mail"]
+
+    def send_one(message):
+        with app.app_context():
+            with state.connect() as connection:
+                connection.send(message)
+
+    threads = []
+
+    def spawn(message):
+        thread = threading.Thread(target=send_one, args=(message,))
+        thread.start()
+        threads.append(thread)
+
+    started, peak = burst(spawn, total)
+    for thread in threads:
+        thread.join()
+    report("thread per message", total, started, peak)
+
+    with app.app_context():
+        started, peak = burst(app.mailer.submit, total)
+        app.mailer.join()
+    report(f"dispatcher ({app.config['MAIL_WORKERS']} workers)", total,
+           started, peak)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Compare indexing throughput and query latency of the search backends.
+
+    python benchmarks/search.py [posts] [queries]
+
+The SQLite FTS5 backend is always measured, Elasticsearch only when
+ELASTICSEARCH_URL is set. Both load the same synthetic corpus into a
+"bench-post" index.
+"""
+import os, sys, random, statistics, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elasticsearch import Elasticsearch
+
+from application.search import ElasticsearchBackend, SQLiteSearchBackend
+from config import Config
+
+WORDS = ["microblog", "flask", "python", "search", "index", "query", "post",
+         "follow", "timeline", "message", "export", "redis", "worker",
+         "cache", "latency", "throughput", "elastic", "sqlite", "token",
+         "notification", "translate", "language", "avatar", "profile"]
+
+
+def corpus(total, seed=42):
+    rng = random.Random(seed)
+    for id in range(1, total + 1):
+        yield id, {"body": " ".join(rng.choice(WORDS) for _ in range(12)) +
+                   f" post{id}"}
+
+
+def measure(name, backend, total, queries):
+    started = time.perf_counter()
+    result = backend.rebuild("bench-post", corpus(total), batch_size=1000,
+                             workers=4)
+    elapsed = time.perf_counter() - started
+    print(f"{name}: indexed {result['indexed']} posts in {elapsed:.2f}s "
+          f"({result['indexed'] / elapsed:.0f} docs/s)")
+    rng = random.Random(7)
+    timings = []
+    for _ in range(queries):
+        query = " ".join(rng.sample(WORDS, 2))
+        started = time.perf_counter()
+        backend.search("bench-post", query, 25)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{name}: {queries} queries, p50 {statistics.median(timings):.2f}ms"
+          f", p95 {timings[int(len(timings) * 0.95) - 1]:.2f}ms")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    path = os.path.join(tempfile.mkdtemp(), "search.db")
+    measure("sqlite", SQLiteSearchBackend(path), total, queries)
+    os.remove(path)
+    if Config.ELASTICSEARCH_URL:
+        client = Elasticsearch([Config.ELASTICSEARCH_URL])
+        measure("elasticsearch", ElasticsearchBackend(client), total,
+                queries)
+        client.indices.delete(index="bench-post-*")
+    else:
+        print("elasticsearch: skipped, ELASTICSEARCH_URL is not set")
+
+
+if __name__ == "__main__":
+    main()
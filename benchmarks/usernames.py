@@ -0,0 +1,92 @@
+"""Measure username prefix lookups on a large synthetic user table.
+
+    python benchmarks/usernames.py [users] [lookups] [--redis]
+
+Reports the index build time and p50/p99 latency of index lookups and of
+the /users/autocomplete endpoint. --redis uses the Redis sorted set index
+at REDIS_URL instead of the in-process one.
+"""
+import os, sys, random, string, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import create_app, db
+from application.models.user import User
+from config import Config
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return (timings[len(timings) // 2],
+            timings[min(int(len(timings) * 0.99), len(timings) - 1)])
+
+
+def usernames(total, seed=42):
+    rng = random.Random(seed)
+    seen = set()
+    while len(seen) < total:
+        name = "".join(rng.choice(string.ascii_lowercase)
+                       for _ in range(rng.randint(4, 12)))
+        if name not in seen:
+            seen.add(name)
+            yield name
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    total = int(args[0]) if args else 1000000
+    lookups = int(args[1]) if len(args) > 1 else 10000
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{path}"
+        USERNAME_INDEX_REDIS = "--redis" in sys.argv
+        LOG_TO_STDOUT = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        batch = []
+        for i, name in enumerate(usernames(total)):
+            batch.append({"username": name, "email": f"{i}@example.com"})
+            if len(batch) == 10000:
+                db.session.execute(User.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(User.__table__.insert(), batch)
+        db.session.commit()
+        print(f"seeded {total} users")
+
+        started = time.perf_counter()
+        app.username_index.rebuild()
+        print(f"built {type(app.username_index).__name__} in "
+              f"{time.perf_counter() - started:.2f}s")
+
+        rng = random.Random(7)
+        prefixes = ["".join(rng.choice(string.ascii_lowercase)
+                            for _ in range(rng.randint(1, 4)))
+                    for _ in range(lookups)]
+        timings = []
+        for prefix in prefixes:
+            started = time.perf_counter()
+            app.username_index.complete(prefix, 10)
+            timings.append((time.perf_counter() - started) * 1000)
+        p50, p99 = percentiles(timings)
+        print(f"index: {lookups} lookups, p50 {p50:.3f}ms, p99 {p99:.3f}ms")
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = "1"
+        timings = []
+        for prefix in prefixes[:1000]:
+            started = time.perf_counter()
+            client.get(f"/users/autocomplete?q={prefix}")
+            timings.append((time.perf_counter() - started) * 1000)
+        p50, p99 = percentiles(timings)
+        print(f"endpoint: {len(timings)} requests, p50 {p50:.3f}ms, "
+              f"p99 {p99:.3f}ms")
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
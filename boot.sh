@@ -9,4 +9,4 @@ while true; do
     sleep 5
 done
 # flask translate compile
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
\ No newline at end of file
+exec gunicorn -b :5000 -k gthread --threads ${WEB_THREADS:-32} --access-logfile - --error-logfile - microblog:app
\ No newline at end of file
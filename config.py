@@ -17,6 +17,12 @@ class Config(object):
     MAIL_USE_TLS = environ.get("MAIL_USE_TLS") is not None
     MAIL_USERNAME = environ.get("MAIL_USERNAME")
     MAIL_PASSWORD = environ.get("MAIL_PASSWORD")
+    MAIL_WORKERS = int(environ.get("MAIL_WORKERS") or 2)
+    MAIL_BATCH_SIZE = int(environ.get("MAIL_BATCH_SIZE") or 20)
+    MAIL_QUEUE_SIZE = int(environ.get("MAIL_QUEUE_SIZE") or 500)
+    MAIL_QUEUE_TIMEOUT = float(environ.get("MAIL_QUEUE_TIMEOUT") or 2)
+    MAIL_RETRIES = int(environ.get("MAIL_RETRIES") or 3)
+    MAIL_RETRY_BACKOFF = float(environ.get("MAIL_RETRY_BACKOFF") or 1)
     ADMINS = environ.get("MAIL_ADMINS") or ["koowusuboaky@gmail.com"]
 
     POSTS_PER_PAGE = 10
@@ -25,12 +31,93 @@ class Config(object):
     LANGUAGES = ["en", "es"]
     #LANGUAGES = [en-US, en-GB, en-CA]
 
+    LANGUAGE_DETECTOR = environ.get("LANGUAGE_DETECTOR") or "guess_language"
+    LANGUAGE_DETECTOR_PRELOAD = \
+        environ.get("LANGUAGE_DETECTOR_PRELOAD", "1") != "0"
+    LANGUAGE_ASYNC = environ.get("LANGUAGE_ASYNC", "1") != "0"
+    LANGUAGE_SYNC_MAX_CHARS = int(
+        environ.get("LANGUAGE_SYNC_MAX_CHARS") or 64)
+
     MS_TRANSLATOR_KEY = environ.get("MS_TRANSLATOR_KEY")
     MS_TRANSLATOR_REGION = environ.get("MS_TRANSLATOR_REGION") or "eastus2"
+    MS_TRANSLATOR_URL = environ.get("MS_TRANSLATOR_URL") or \
+        "https://api.cognitive.microsofttranslator.com"
+    TRANSLATOR_TIMEOUT = float(environ.get("TRANSLATOR_TIMEOUT") or 5)
+    TRANSLATOR_POOL_SIZE = int(environ.get("TRANSLATOR_POOL_SIZE") or 10)
+    TRANSLATOR_BATCH_SIZE = int(environ.get("TRANSLATOR_BATCH_SIZE") or 100)
+    TRANSLATOR_BATCH_CHARS = int(
+        environ.get("TRANSLATOR_BATCH_CHARS") or 50000)
+    TRANSLATE_MAX_ITEMS = int(environ.get("TRANSLATE_MAX_ITEMS") or 100)
+    TRANSLATION_CACHE_SIZE = int(environ.get("TRANSLATION_CACHE_SIZE") or 4096)
+    TRANSLATION_CACHE_TTL = int(environ.get("TRANSLATION_CACHE_TTL") or 86400)
+    TRANSLATION_CACHE_REDIS = environ.get("TRANSLATION_CACHE_REDIS") is not None
+    TRANSLATION_ERROR_TTL = int(environ.get("TRANSLATION_ERROR_TTL") or 60)
+    PRETRANSLATE = environ.get("PRETRANSLATE") is not None
+    PRETRANSLATE_MIN_FOLLOWERS = int(
+        environ.get("PRETRANSLATE_MIN_FOLLOWERS") or 100)
+    PRETRANSLATE_MIN_VIEWS = int(environ.get("PRETRANSLATE_MIN_VIEWS") or 50)
+    PRETRANSLATE_MAX_QUEUE = int(environ.get("PRETRANSLATE_MAX_QUEUE") or 100)
+    PRETRANSLATE_DAILY_CHARS = int(
+        environ.get("PRETRANSLATE_DAILY_CHARS") or 200000)
 
     ELASTICSEARCH_URL = environ.get("ELASTICSEARCH_URL")
+    SEARCH_BACKEND = environ.get("SEARCH_BACKEND") or \
+        ("elasticsearch" if ELASTICSEARCH_URL else "sqlite")
+    SEARCH_INDEX_PATH = environ.get("SEARCH_INDEX_PATH") or \
+        path.join(basedir, "search.db")
+    SEARCH_REINDEX_BATCH_SIZE = int(
+        environ.get("SEARCH_REINDEX_BATCH_SIZE") or 500)
+    SEARCH_REINDEX_WORKERS = int(environ.get("SEARCH_REINDEX_WORKERS") or 4)
+    SEARCH_OUTBOX_BATCH_SIZE = int(
+        environ.get("SEARCH_OUTBOX_BATCH_SIZE") or 500)
+    SEARCH_OUTBOX_INTERVAL = float(environ.get("SEARCH_OUTBOX_INTERVAL") or 1)
+    SEARCH_OUTBOX_MAX_LAG = float(environ.get("SEARCH_OUTBOX_MAX_LAG") or 30)
+    SEARCH_OUTBOX_MAX_ATTEMPTS = int(
+        environ.get("SEARCH_OUTBOX_MAX_ATTEMPTS") or 5)
+    SEARCH_OUTBOX_RETRY_BACKOFF = float(
+        environ.get("SEARCH_OUTBOX_RETRY_BACKOFF") or 10)
     REDIS_URL = environ.get("REDIS_URL") or "redis://"
 
     LOG_TO_STDOUT = environ.get("LOG_TO_STDOUT")
 
     EXPORT_TASK_QUEUE = environ.get("EXPORT_TASK_QUEUE") or "microblog-tasks"
+    EXPORT_STORAGE_PATH = environ.get("EXPORT_STORAGE_PATH") or \
+        path.join(basedir, "exports")
+    EXPORT_TTL = int(environ.get("EXPORT_TTL") or 7 * 24 * 3600)
+    USE_X_SENDFILE = environ.get("USE_X_SENDFILE") is not None
+    # sharded exports need EXPORT_STORAGE_PATH shared by all task workers
+    EXPORT_SHARD_SIZE = int(environ.get("EXPORT_SHARD_SIZE") or 0)
+    EXPORT_BATCH_SIZE = int(environ.get("EXPORT_BATCH_SIZE") or 1000)
+    EXPORT_SPOOL_SIZE = int(environ.get("EXPORT_SPOOL_SIZE") or 1024 * 1024)
+    EXPORT_FORMAT = environ.get("EXPORT_FORMAT") or "json"
+    EXPORT_COMPRESS = environ.get("EXPORT_COMPRESS") is not None
+    TASK_PROGRESS_STEP = int(environ.get("TASK_PROGRESS_STEP") or 5)
+    TASK_PROGRESS_INTERVAL = float(environ.get("TASK_PROGRESS_INTERVAL") or 1)
+
+    NOTIFICATION_STREAM = environ.get("NOTIFICATION_STREAM") is not None
+    NOTIFICATION_STREAM_KEEPALIVE = int(
+        environ.get("NOTIFICATION_STREAM_KEEPALIVE") or 15)
+
+    TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE") or 1024)
+    TOKEN_CACHE_TTL = int(environ.get("TOKEN_CACHE_TTL") or 60)
+    # tokens are cached only when IDENTITY_CACHE is on too
+    TOKEN_CACHE_REDIS = environ.get("TOKEN_CACHE_REDIS", "1") != "0"
+
+    # cached in Redis, shared by every process
+    IDENTITY_CACHE = environ.get("IDENTITY_CACHE") is not None
+    IDENTITY_CACHE_TTL = int(environ.get("IDENTITY_CACHE_TTL") or 60)
+
+    SEARCH_CACHE_SIZE = int(environ.get("SEARCH_CACHE_SIZE") or 1024)
+    SEARCH_CACHE_TTL = int(environ.get("SEARCH_CACHE_TTL") or 10)
+    SEARCH_CACHE_REDIS = environ.get("SEARCH_CACHE_REDIS") is not None
+
+    LAST_SEEN_RESOLUTION = int(environ.get("LAST_SEEN_RESOLUTION") or 60)
+    LAST_SEEN_FLUSH_SIZE = int(environ.get("LAST_SEEN_FLUSH_SIZE") or 100)
+    LAST_SEEN_FLUSH_INTERVAL = int(environ.get("LAST_SEEN_FLUSH_INTERVAL") or 60)
+    LAST_SEEN_REDIS = environ.get("LAST_SEEN_REDIS") is not None
+
+    USERNAME_INDEX_REDIS = environ.get("USERNAME_INDEX_REDIS") is not None
+    USERNAME_COMPLETIONS = int(environ.get("USERNAME_COMPLETIONS") or 10)
+    USERNAME_INDEX_SYNC_INTERVAL = float(
+        environ.get("USERNAME_INDEX_SYNC_INTERVAL") or 5)
+    USERNAME_INDEX_LOG_SIZE = int(environ.get("USERNAME_INDEX_LOG_SIZE") or 1000)
@@ -0,0 +1,7 @@
+# Read by gunicorn from the working directory, see boot.sh and Procfile.
+
+
+def post_worker_init(worker):
+    # load the username index before the worker takes its first request
+    # rather than in it
+    worker.wsgi.username_index.warm()
@@ -1,10 +1,49 @@
+import gzip
+import io
+import json
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-from application import create_app, db
-from application.models.user import User
+import rq
+
+from elasticsearch.exceptions import NotFoundError
+from flask import url_for
+from flask_mail import Message as MailMessage
+from sqlalchemy import event
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from application import create_app, db, tasks
+from application.models.user import User, followers, load_user
 from application.models.post import Post
+from application.models.message import Message
+from application.models.notification import Notification
+from application.models.task import Task
+from application.models.search_outbox import SearchOutbox
+from application.storage import LocalStorage
+from application.cache import LRUCache, RedisCache, TieredCache, \
+    cache_stats
+from application.pagination import keyset_paginate, decode_cursor
+from application.search import ElasticsearchBackend
+from application.last_seen import LastSeenBuffer
+from application.usernames import LocalUsernameIndex, RedisUsernameIndex
+from application.translate import translate, translate_many
+from application.email import MailDispatcher, MailQueueFull, send_mail
+from application.language import LangdetectDetector, detect_language
+from application.pretranslate import Pretranslator
 
 from config import Config
 
@@ -12,6 +51,26 @@ from config import Config
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URL = "sqlite://"
+    SEARCH_BACKEND = "sqlite"
+    LANGUAGE_ASYNC = False
+    SEARCH_INDEX_PATH = ":memory:"
+    TOKEN_CACHE_REDIS = False
+    USERNAME_INDEX_SYNC_INTERVAL = 0
+
+
+@contextmanager
+def count_statements():
+    """Collect the SQL statements run on db.engine in the yielded list."""
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
 
 
 class UserModelCase(unittest.TestCase):
@@ -99,6 +158,1307 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+        # check the denormalized counters
+        self.assertEqual((u1.post_count, u1.following_count,
+                          u1.follower_count), (1, 2, 0))
+        self.assertEqual((u4.post_count, u4.following_count,
+                          u4.follower_count), (1, 0, 2))
+        u1.unfollow(u4)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.following_count), (0, 1))
+        self.assertEqual(u4.follower_count, 1)
+
+        u1.post_count = 42
+        db.session.commit()
+        User.recompute_counters()
+        db.session.commit()
+        self.assertEqual(u1.post_count, 0)
+
+    def test_timeline(self):
+        u1 = User(username='nana', email='nana@example.com')
+        u2 = User(username='kwame', email='kwame@example.com')
+        u3 = User(username='abena', email='abena@example.com')
+        db.session.add_all([u1, u2, u3])
+
+        now = datetime.utcnow()
+        p1 = Post(body="post from nana", author=u1,
+                  created_on=now + timedelta(seconds=1))
+        p2 = Post(body="post from kwame", author=u2,
+                  created_on=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        # following backfills, new posts fan out to followers
+        u1.follow(u2)
+        u3.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p2, p1])
+        p3 = Post(body="another post from kwame", author=u2,
+                  created_on=now + timedelta(seconds=3))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p3, p2, p1])
+        self.assertEqual(u2.timeline_posts().all(), [p3, p2])
+        self.assertEqual(u3.timeline_posts().all(), [p1])
+
+        # unfollowing prunes
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p1])
+
+        # evicted timelines are rebuilt from the following query
+        u1.follow(u2)
+        u1.evict_timeline()
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(),
+                         u1.following_posts().all())
+        self.assertIsNotNone(u1.timeline_built_on)
+
+    def test_keyset_pagination(self):
+        u = User(username='nana', email='nana@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body=f"post {i}", author=u,
+                      created_on=now + timedelta(seconds=i // 2))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.created_on, p.id),
+                              reverse=True)
+        keys = (Post.created_on, Post.id)
+
+        page1 = keyset_paginate(Post.query, 2, keys)
+        self.assertEqual(page1.items, newest_first[:2])
+        self.assertFalse(page1.has_prev)
+        page2 = keyset_paginate(Post.query, 2, keys,
+                                before=decode_cursor(page1.next_cursor))
+        self.assertEqual(page2.items, newest_first[2:4])
+        page3 = keyset_paginate(Post.query, 2, keys,
+                                before=decode_cursor(page2.next_cursor))
+        self.assertEqual(page3.items, newest_first[4:])
+        self.assertFalse(page3.has_next)
+        back = keyset_paginate(Post.query, 2, keys,
+                               after=decode_cursor(page3.prev_cursor))
+        self.assertEqual(back.items, page2.items)
+        self.assertTrue(back.has_prev)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_token_cache(self):
+        self.app.config['IDENTITY_CACHE'] = True
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.token_cache = RedisCache(self.app.redis, 'microblog:token:')
+        self.app.identity_cache = RedisCache(self.app.redis,
+                                             'microblog:identity:')
+        u = User(username='nana', email='nana@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        with count_statements() as statements:
+            self.assertEqual(User.verify_token(token).id, user_id)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(User.verify_token(token).username, 'nana')
+            self.assertEqual(len(statements), 1)
+
+        # a revoke in another worker is seen through the shared cache
+        other = create_app(TestConfig)
+        other.config['IDENTITY_CACHE'] = True
+        other.redis = self.app.redis
+        other.token_cache = RedisCache(other.redis, 'microblog:token:')
+        other.identity_cache = RedisCache(other.redis, 'microblog:identity:')
+        with other.app_context():
+            User.query.get(user_id).revoke_token()
+            db.session.commit()
+        u = User.query.get(user_id)
+        self.assertIsNone(User.verify_token(token))
+        new_token = u.get_token()
+        db.session.commit()
+        self.assertNotEqual(new_token, token)
+        self.assertIsNone(User.verify_token(token))
+        self.assertEqual(User.verify_token(new_token), u)
+
+    def test_last_seen_buffer(self):
+        u = User(username='nana', email='nana@example.com',
+                 last_seen=datetime(2020, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+        buffer = self.app.last_seen
+        buffer.touch(u)
+        seen = u.get_last_seen()
+        self.assertGreater(seen, datetime(2020, 1, 1))
+        buffer.touch(u)
+        self.assertEqual(u.get_last_seen(), seen)
+        self.assertEqual(buffer.flush(), 1)
+        db.session.expire(u)
+        self.assertEqual(u.last_seen, seen)
+        self.assertEqual(buffer.flush(), 0)
+
+        # buffered values are flushed in the background when no one touches
+        buffer = LastSeenBuffer(self.app)
+        buffer.flush_interval = 0.2
+        buffer.resolution = timedelta(0)
+        buffer.touch(u)
+        time.sleep(0.5)
+        self.assertEqual(buffer.get_many([u.id]), {})
+        db.session.expire(u)
+        self.assertGreater(u.last_seen, seen)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_last_seen_redis(self):
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.config['LAST_SEEN_REDIS'] = True
+        self.app.last_seen = LastSeenBuffer(self.app)
+        users = [User(username=name, email=f'{name}@example.com',
+                      last_seen=datetime(2020, 1, 1))
+                 for name in ['nana', 'kwame', 'kofi']]
+        db.session.add_all(users)
+        db.session.commit()
+        self.app.last_seen.touch(users[0])
+        self.app.last_seen.touch(users[1])
+        with mock.patch.object(self.app.redis, 'hget') as hget, \
+                mock.patch.object(self.app.redis, 'hmget',
+                                  wraps=self.app.redis.hmget) as hmget:
+            with self.app.test_request_context():
+                data = User.to_dict_many(users)
+        hget.assert_not_called()
+        self.assertEqual(hmget.call_count, 1)
+        self.assertEqual([item['last_seen'] for item in data[:2]], [
+            self.app.last_seen.get(user.id).isoformat() + 'Z'
+            for user in users[:2]])
+        self.assertEqual(data[2]['last_seen'],
+                         users[2].last_seen.isoformat() + 'Z')
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_identity_cache(self):
+        self.app.config['IDENTITY_CACHE'] = True
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.identity_cache = RedisCache(
+            self.app.redis, 'microblog:identity:', report_every=2)
+        u = User(username='nana', email='nana@example.com')
+        db.session.add(u)
+        db.session.commit()
+        cache = self.app.identity_cache
+        self.assertEqual(load_user(str(u.id)), u)
+        db.session.remove()
+
+        with count_statements() as statements:
+            cached = load_user(str(u.id))
+            self.assertEqual(cached.username, 'nana')
+        self.assertEqual(statements, [])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache_stats(self.app.redis),
+                         {'microblog:identity': (1, 1)})
+
+        # a change made by another worker is seen through the shared cache
+        other = create_app(TestConfig)
+        other.config['IDENTITY_CACHE'] = True
+        other.redis = self.app.redis
+        other.identity_cache = RedisCache(other.redis, 'microblog:identity:')
+        user_id = u.id
+        with other.app_context():
+            User.query.get(user_id).username = 'kwame'
+            db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(str(user_id)).username, 'kwame')
+        self.assertEqual(cache.misses, 2)
+
+    def test_unread_message_count(self):
+        u1 = User(username='nana', email='nana@example.com')
+        u2 = User(username='kwame', email='kwame@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        Message(author=u1, recipient=u2, body='hello').save()
+        Message(author=u1, recipient=u2, body='are you there?').save()
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(u1.new_messages(), 0)
+
+        u2.mark_messages_read()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+        Message(author=u1, recipient=u2, body='hello again').save()
+        self.assertEqual(u2.new_messages(), 1)
+
+        u2.unread_message_count = 5
+        db.session.commit()
+        User.recompute_counters()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 1)
+
+    def test_collection_query_count(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(100)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body=f"post {i}", author=u)
+                            for i, u in enumerate(users)])
+        db.session.commit()
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.commit()
+
+        with self.app.test_request_context():
+            for model in (User, Post):
+                with count_statements() as statements:
+                    data = model.to_collection_dict(
+                        model.query, 1, 100, "api.get_users")
+                self.assertEqual(len(data["items"]), 100)
+                self.assertLessEqual(len(statements), 2)
+
+    def test_collection_links(self):
+        u = User(username='nana', email='nana@example.com')
+        db.session.add(u)
+        db.session.commit()
+        # digits elsewhere in the URL are left alone
+        with self.app.test_request_context(
+                base_url='http://host1.example.com/app98765432100/'):
+            links = u.to_dict()['_links']
+            self.assertEqual(links['self'], url_for('api.get_user', id=u.id))
+            self.assertEqual(links['followers'],
+                             url_for('api.get_followers', id=u.id))
+            self.assertTrue(links['followers'].startswith('/app98765432100/'))
+
+    def test_username_autocomplete(self):
+        names = ['Nana', 'nanette', 'nab', 'kwame', 'Kofi', 'nana2']
+        db.session.add_all([User(username=name, email=f'{name}@example.com')
+                            for name in names])
+        db.session.commit()
+        index = self.app.username_index
+        self.assertEqual(index.complete('na'),
+                         ['nab', 'Nana', 'nana2', 'nanette'])
+        self.assertEqual(index.complete('NAN', limit=2), ['Nana', 'nana2'])
+        self.assertEqual(index.complete('z'), [])
+
+        kofi = User.query.filter_by(username='Kofi').first()
+        kofi.username = 'nanakofi'
+        db.session.commit()
+        kofi.username = 'nanarollback'
+        db.session.flush()
+        db.session.rollback()
+        db.session.add(User(username='kojo', email='kojo@example.com'))
+        db.session.commit()
+        self.assertEqual(index.complete('ko'), ['kojo'])
+        self.assertEqual(index.complete('nanak'), ['nanakofi'])
+        self.assertEqual(index.complete('nanar'), [])
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(kofi.id)
+        response = client.get('/users/autocomplete?q=kw')
+        self.assertEqual(response.get_json(), {'usernames': ['kwame']})
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_username_index_sync(self):
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.config['USERNAME_INDEX_SYNC_INTERVAL'] = 0.01
+        self.app.username_index = LocalUsernameIndex(self.app)
+        other = LocalUsernameIndex(self.app)
+        db.session.add(User(username='nana', email='nana@example.com'))
+        db.session.commit()
+        self.assertEqual(other.complete('n'), ['nana'])
+        self.assertEqual(self.app.username_index.complete('n'), ['nana'])
+
+        nab = User(username='nab', email='nab@example.com')
+        db.session.add(nab)
+        db.session.commit()
+        self.assertEqual(other.complete('n'), ['nana'])
+        time.sleep(0.02)
+        with mock.patch.object(other, '_load') as load:
+            # the missed changes are replayed from the log, not reloaded
+            self.assertEqual(other.complete('n'), ['nab', 'nana'])
+            nab.username = 'nabi'
+            db.session.commit()
+            time.sleep(0.02)
+            self.assertEqual(other.complete('n'), ['nabi', 'nana'])
+        with mock.patch.object(self.app.username_index, '_load') as load:
+            time.sleep(0.02)
+            self.assertEqual(self.app.username_index.complete('n'),
+                             ['nabi', 'nana'])
+        load.assert_not_called()
+
+        other.log_size = self.app.username_index.log_size = 1
+        db.session.add_all([User(username='nk', email='nk@example.com'),
+                            User(username='nkem', email='nkem@example.com')])
+        db.session.commit()
+        self.app.username_index.update([('nk', None)])
+        time.sleep(0.02)
+        self.assertEqual(other.complete('n'), ['nabi', 'nana', 'nk', 'nkem'])
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_username_index(self):
+        self.app.redis = fakeredis.FakeStrictRedis()
+        index = RedisUsernameIndex(self.app)
+        self.app.username_index = index
+        db.session.add_all([User(username=name, email=f'{name}@example.com')
+                            for name in ['Nana', 'nab', 'kwame']])
+        db.session.commit()
+        self.assertEqual(index.complete('na'), ['nab', 'Nana'])
+        self.app.redis.flushall()
+        self.assertEqual(index.rebuild(), 3)
+        self.assertEqual(index.complete('K'), ['kwame'])
+
+
+class FeedRenderingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def render(self, url, authors):
+        reader = User(username='reader', email='reader@example.com')
+        db.session.add(reader)
+        for i in range(authors):
+            u = User(username=f'author{i}', email=f'author{i}@example.com')
+            db.session.add(Post(body=f"post {i}", author=u))
+            reader.follow(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(reader.id)
+        db.session.remove()
+
+        with count_statements() as statements:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        return len(statements)
+
+    def test_no_lazy_author_loads(self):
+        for url in ('/index', '/explore'):
+            self.assertEqual(self.render(url, 2), self.render(url, 8), url)
+
+    def test_popup_uses_counters(self):
+        u1 = User(username='nana', email='nana@example.com')
+        u2 = User(username='kwame', email='kwame@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        db.session.remove()
+
+        with count_statements() as statements:
+            response = self.client.get('/user/kwame/popup')
+        self.assertIn(b'1 followers', response.data)
+        # only the is_following check counts rows
+        self.assertEqual(len([s for s in statements
+                              if 'count(' in s.lower()]), 1)
+
+
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def query_plan(self, query):
+        compiled = query.statement.compile(db.engine)
+        params = tuple(compiled.params[key] for key in compiled.positiontup)
+        rows = db.session.connection().exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + str(compiled), params).fetchall()
+        return " ".join(row[-1] for row in rows)
+
+    def test_hot_queries_use_indexes(self):
+        u1 = User(username='nana', email='nana@example.com')
+        u2 = User(username='kwame', email='kwame@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        since = datetime.utcnow()
+        queries = {
+            "is_following": u1.following.filter(
+                followers.c.following_id == u2.id),
+            "profile": u1.posts.order_by(Post.created_on.desc()),
+            "new_messages": Message.query.filter_by(recipient=u1).filter(
+                Message.created_on > since),
+            "add_notification": u1.notifications.filter_by(name="n"),
+            "notifications": u1.notifications.filter(
+                Notification.created_on > since),
+            "task_in_progress": Task.query.filter_by(
+                name="export_posts", user=u1, complete=False),
+            "verify_token": User.query.filter_by(token="token"),
+        }
+        for name, query in queries.items():
+            plan = self.query_plan(query)
+            self.assertIn("USING", plan, name)
+            self.assertNotIn("SCAN", plan, name)
+
+
+class FakeJob(object):
+    def __init__(self, id):
+        self.id = id
+        self.meta = {}
+        self.saves = 0
+
+    def get_id(self):
+        return self.id
+
+    def save_meta(self):
+        self.saves += 1
+
+
+class TasksCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['TASK_PROGRESS_INTERVAL'] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_progress_is_coalesced(self):
+        u = User(username='nana', email='nana@example.com')
+        db.session.add(Task(id='job1', name='export_posts', user=u))
+        db.session.commit()
+        job = FakeJob('job1')
+        total = 20000
+        with mock.patch.object(tasks, 'get_current_job', return_value=job):
+            tasks._set_task_progress(0)
+            for i in range(1, total + 1):
+                tasks._set_task_progress(100 * i // total)
+        step = self.app.config['TASK_PROGRESS_STEP']
+        self.assertLessEqual(job.saves, 100 // step + 2)
+        self.assertEqual(job.meta['progress'], 100)
+        self.assertTrue(Task.query.get('job1').complete)
+        self.assertEqual(u.notifications.count(), 1)
+
+    def test_export_file(self):
+        now = datetime.utcnow()
+        posts = [("post %d" % i, now + timedelta(seconds=i))
+                 for i in range(3)]
+        archive, count = tasks.export_posts_file(iter(posts))
+        self.assertEqual(count, 3)
+        data = json.loads(archive.read().decode('utf-8'))
+        self.assertEqual([p['body'] for p in data['posts']],
+                         ['post 0', 'post 1', 'post 2'])
+
+        archive, count = tasks.export_posts_file(
+            iter(posts), format='ndjson', compress=True)
+        lines = gzip.decompress(archive.read()).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[2])['body'], 'post 2')
+        self.assertEqual(json.loads(tasks.export_posts_file(
+            iter([]))[0].read()), {'posts': []})
+
+        # SpooledTemporaryFile only became a full io object in Python 3.11
+        class BareSpool(object):
+            def __init__(self, max_size=0):
+                self.buffer = io.BytesIO()
+                self.write = self.buffer.write
+                self.read = self.buffer.read
+                self.seek = self.buffer.seek
+                self.tell = self.buffer.tell
+                self.close = self.buffer.close
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.close()
+
+        with mock.patch.object(tasks.tempfile, 'SpooledTemporaryFile',
+                               BareSpool):
+            for compress in (False, True):
+                archive, count = tasks.export_posts_file(
+                    iter([('café', now)]), compress=compress)
+                data = archive.read()
+                if compress:
+                    data = gzip.decompress(data)
+                self.assertEqual(json.loads(data.decode('utf-8'))['posts'][0]
+                                 ['body'], 'café')
+
+    def test_export_download(self):
+        storage = LocalStorage(tempfile.mkdtemp())
+        self.app.export_storage = tasks.app.export_storage = storage
+        u1 = User(username='nana', email='nana@example.com')
+        u2 = User(username='kwame', email='kwame@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body=f"post {i}", author=u1)
+                            for i in range(50)])
+        db.session.add(Task(id='job1', name='export_posts', user=u1))
+        db.session.commit()
+        with mock.patch.object(tasks, 'get_current_job',
+                               return_value=FakeJob('job1')), \
+                mock.patch.object(tasks, 'send_mail') as send_mail:
+            tasks.export_posts(u1.id, 'https://microblog.example.com/')
+        self.assertIn('https://microblog.example.com/exports/job1',
+                      send_mail.call_args.kwargs['body'])
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        response = client.get('/exports/job1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['posts']), 50)
+        etag = response.headers['ETag']
+        response = client.get('/exports/job1', headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b'{"posts": ')
+        response = client.get('/exports/job1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        self.assertEqual(client.get('/exports/job1').status_code, 404)
+
+        self.assertEqual(Task.cleanup_artifacts(storage, -1), 1)
+        self.assertIsNone(Task.query.get('job1').artifact)
+
+    def test_language_detection(self):
+        self.app.config['LANGUAGE_ASYNC'] = True
+        self.app.task_queue = mock.Mock()
+        u = User(username='nana', email='nana@example.com')
+        short = Post(body='Esto es una prueba corta', author=u)
+        long = Post(body='Esta es una publicación bastante más larga que '
+                         'se analiza en segundo plano después de guardarla',
+                    author=u)
+        given = Post(body='Whatever this says', language='fr', author=u)
+        db.session.add_all([short, long, given])
+        db.session.commit()
+        self.assertEqual((short.language, long.language, given.language),
+                         ('es', None, 'fr'))
+        self.app.task_queue.enqueue.assert_called_once_with(
+            'application.tasks.detect_post_language', [long.id])
+
+        tasks.detect_post_language([long.id, short.id])
+        self.assertEqual(Post.query.get(long.id).language, 'es')
+
+        db.session.add(Post(body=long.body, author=u))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.app.task_queue.enqueue.call_count, 1)
+
+    def test_langdetect_detector(self):
+        detector = LangdetectDetector()
+        self.assertEqual(detector.detect('Ceci est une phrase en français'),
+                         'fr')
+        self.assertIsNone(detector.detect('1234'))
+        self.assertEqual(detect_language(detector, ''), '')
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_sharded_export(self):
+        storage = LocalStorage(tempfile.mkdtemp())
+        self.app.export_storage = tasks.app.export_storage = storage
+        self.app.redis = tasks.app.redis = fakeredis.FakeStrictRedis()
+        self.app.task_queue = tasks.app.task_queue = rq.Queue(
+            'microblog-tasks', is_async=False, connection=self.app.redis)
+        tasks.app.config['EXPORT_SHARD_SIZE'] = 7
+        self.addCleanup(tasks.app.config.__setitem__, 'EXPORT_SHARD_SIZE', 0)
+        u = User(username='nana', email='nana@example.com')
+        now = datetime.utcnow()
+        # equal timestamps across a shard boundary keep their id order
+        db.session.add_all([Post(body=f"post {i}", author=u,
+                                 created_on=now + timedelta(seconds=i // 3))
+                            for i in range(30)])
+        db.session.add(Task(id='job1', name='export_posts', user=u))
+        db.session.commit()
+        with mock.patch.object(tasks, 'send_mail') as send_mail, \
+                mock.patch.object(storage, 'open', wraps=storage.open) as read:
+            self.app.task_queue.enqueue('application.tasks.export_posts',
+                                        u.id, job_id='job1')
+        send_mail.assert_called_once()
+        # chunks are read back through the storage, not its local paths
+        self.assertEqual(read.call_count, 5)
+        task = Task.query.get('job1')
+        self.assertTrue(task.complete)
+        self.assertEqual(task.get_rq_job().meta['progress'], 100)
+        with open(storage.path(task.artifact)) as f:
+            posts = json.load(f)['posts']
+        self.assertEqual([p['body'] for p in posts],
+                         [f"post {i}" for i in range(30)])
+        self.assertFalse(any('chunks' in key for key in storage.cleanup(-1)))
+
+        # a failed chunk fails the task and leaves no chunk files behind
+        db.session.add(Task(id='job2', name='export_posts', user=u))
+        db.session.commit()
+        records = tasks.post_records
+        calls = []
+
+        def flaky_records(posts):
+            calls.append(1)
+            if len(calls) == 2:
+                raise IOError('disk full')
+            return records(posts)
+
+        with mock.patch.object(tasks, 'send_mail') as send_mail, \
+                mock.patch.object(tasks, 'post_records', flaky_records):
+            self.app.task_queue.enqueue('application.tasks.export_posts',
+                                        u.id, job_id='job2')
+        send_mail.assert_not_called()
+        task = Task.query.get('job2')
+        self.assertTrue(task.complete)
+        self.assertTrue(task.get_rq_job().meta['failed'])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(storage.cleanup(-1), [])
+
+    def test_cleanup_exports(self):
+        storage = LocalStorage(tempfile.mkdtemp())
+        self.app.export_storage = tasks.app.export_storage = storage
+        storage.save(tasks._chunk_key(1, 'job1', 0), io.BytesIO(b'{}'))
+        tasks.app.config['EXPORT_TTL'] = -1
+        self.addCleanup(tasks.app.config.__setitem__, 'EXPORT_TTL',
+                        self.app.config['EXPORT_TTL'])
+        self.assertEqual(tasks.cleanup_exports(), 1)
+        self.assertFalse(storage.exists(tasks._chunk_key(1, 'job1', 0)))
+
+
+class FakeIndices(object):
+    def __init__(self, es):
+        self.es = es
+
+    def create(self, index, body=None):
+        self.es.indices_data[index] = {}
+        for alias in (body or {}).get('aliases', {}):
+            self.es.aliases.setdefault(index, set()).add(alias)
+
+    def exists(self, index):
+        return index in self.es.indices_data
+
+    def delete(self, index):
+        del self.es.indices_data[index]
+        self.es.aliases.pop(index, None)
+
+    def put_settings(self, index, body):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def get_alias(self, name):
+        indices = {index: {} for index, aliases in self.es.aliases.items()
+                   if name in aliases}
+        if not indices:
+            raise NotFoundError(404, 'aliases_not_found_exception')
+        return indices
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            if 'remove_index' in action:
+                self.delete(action['remove_index']['index'])
+            elif 'remove' in action:
+                self.es.aliases[action['remove']['index']].discard(
+                    action['remove']['alias'])
+            else:
+                self.es.aliases.setdefault(action['add']['index'], set()).add(
+                    action['add']['alias'])
+
+
+class FakeElasticsearch(object):
+    """In-memory stand-in for the index, bulk and alias APIs."""
+
+    def __init__(self):
+        self.indices_data = {}
+        self.aliases = {}
+        self.indices = FakeIndices(self)
+        self.bulk_requests = 0
+        self.reject = set()
+
+    def _resolve(self, index):
+        return next((name for name, aliases in self.aliases.items()
+                     if index in aliases), index)
+
+    def index(self, index, id, body):
+        self.indices_data.setdefault(self._resolve(index), {})[id] = body
+
+    def delete(self, index, id):
+        self.indices_data[self._resolve(index)].pop(id, None)
+
+    def bulk(self, body):
+        self.bulk_requests += 1
+        body = iter(body)
+        items = []
+        for action in body:
+            op, meta = next(iter(action.items()))
+            if meta['_id'] in self.reject:
+                if op != 'delete':
+                    next(body)
+                items.append({op: {'_id': meta['_id'], 'status': 400,
+                                   'error': {'type': 'mapper_parsing_exception'}}})
+            elif op == 'delete':
+                self.delete(meta['_index'], meta['_id'])
+                items.append({op: {'_id': meta['_id'], 'status': 200}})
+            elif op == 'create' and meta['_id'] in self.indices_data.get(
+                    self._resolve(meta['_index']), {}):
+                next(body)
+                items.append({op: {'_id': meta['_id'], 'status': 409,
+                                   'error': {'type': 'version_conflict'}}})
+            else:
+                self.index(meta['_index'], meta['_id'], next(body))
+                items.append({op: {'_id': meta['_id'], 'status': 201}})
+        return {'errors': any('error' in next(iter(item.values()))
+                              for item in items), 'items': items}
+
+
+class SearchIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_reindex(self):
+        self.app.search_backend = ElasticsearchBackend(FakeElasticsearch())
+        es = self.app.search_backend.client
+        u = User(username='nana', email='nana@example.com')
+        db.session.add_all([Post(body=f"post {i}", author=u)
+                            for i in range(25)])
+        db.session.commit()
+        SearchOutbox.drain(Post.searchable_models())
+        self.assertEqual(len(es.indices_data['post']), 25)
+        es.bulk_requests = 0
+
+        result = Post.reindex(batch_size=10, workers=2)
+        self.assertEqual((result['indexed'], result['failed']), (25, 0))
+        self.assertEqual(es.bulk_requests, 3)
+        self.assertEqual(es.aliases, {result['index']: {'post'}})
+        self.assertNotIn('post', es.indices_data)
+        self.assertEqual(es.indices_data[result['index']][25],
+                         {'id': 25, 'body': 'post 24'})
+
+        second = Post.reindex(batch_size=10, workers=2)
+        self.assertEqual(es.aliases, {second['index']: {'post'}})
+        self.assertEqual(list(es.indices_data), [second['index']])
+
+        # changes made while the index is rebuilt survive the swap
+        documents = list(Post.search_documents())
+
+        def changing_documents():
+            for i, document in enumerate(documents):
+                if i == 5:
+                    post = Post.query.get(1)
+                    post.body = 'edited during rebuild'
+                    db.session.add(Post(body='posted during rebuild',
+                                        author=u))
+                    db.session.commit()
+                    SearchOutbox.drain(Post.searchable_models())
+                yield document
+
+        third = self.app.search_backend.rebuild('post', changing_documents(),
+                                                batch_size=10, workers=2)
+        self.assertEqual((third['indexed'], third['failed']), (25, 0))
+        self.assertEqual(es.aliases, {third['index']: {'post'}})
+        self.assertEqual(es.indices_data[third['index']][1]['body'],
+                         'edited during rebuild')
+        self.assertEqual(es.indices_data[third['index']][26]['body'],
+                         'posted during rebuild')
+
+    def test_outbox(self):
+        self.app.search_backend = ElasticsearchBackend(FakeElasticsearch())
+        es = self.app.search_backend.client
+        models = Post.searchable_models()
+        u = User(username='nana', email='nana@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(es.bulk_requests, 0)
+        self.assertEqual(SearchOutbox.lag()[0], 2)
+
+        p1.body = 'first, edited'
+        db.session.commit()
+        p1.body = 'first, edited again'
+        db.session.commit()
+        u.about_me = 'not searchable'
+        db.session.commit()
+        self.assertEqual(SearchOutbox.lag()[0], 4)
+
+        self.assertEqual(SearchOutbox.drain(models)[0], 4)
+        self.assertEqual(es.bulk_requests, 1)
+        self.assertEqual(es.indices_data['post'],
+                         {p1.id: {'id': p1.id, 'body': 'first, edited again'},
+                          p2.id: {'id': p2.id, 'body': 'second'}})
+        self.assertEqual(SearchOutbox.lag(), (0, 0.0))
+
+        # documents the bulk response rejects are retried later without
+        # holding up the entries behind them, then become dead letters
+        p3 = Post(body='third', author=u)
+        p4 = Post(body='fourth', author=u)
+        db.session.add_all([p3, p4])
+        db.session.commit()
+        es.reject.add(p3.id)
+        self.assertEqual(SearchOutbox.drain(models, batch_size=1)[0], 0)
+        entry = SearchOutbox.query.filter_by(object_id=p3.id).one()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn('mapper_parsing_exception', entry.last_error)
+        self.assertGreater(entry.retry_on, datetime.utcnow())
+        self.assertEqual(SearchOutbox.drain(models, batch_size=1)[0], 1)
+        self.assertIn(p4.id, es.indices_data['post'])
+        self.assertEqual(SearchOutbox.drain(models)[0], 0)
+        self.assertEqual(SearchOutbox.query.one().attempts, 1)
+
+        self.app.config['SEARCH_OUTBOX_MAX_ATTEMPTS'] = 2
+        entry.retry_on = None
+        db.session.commit()
+        self.assertEqual(SearchOutbox.drain(models)[0], 0)
+        self.assertTrue(SearchOutbox.query.one().dead)
+        self.assertEqual(SearchOutbox.lag(), (0, 0.0))
+        self.assertEqual(SearchOutbox.dead_letters(), 1)
+        es.reject.clear()
+        self.assertEqual(SearchOutbox.requeue(), 1)
+        self.assertEqual(SearchOutbox.drain(models)[0], 1)
+        self.assertEqual(SearchOutbox.query.count(), 0)
+
+        p2.delete()
+        with mock.patch.object(es, 'bulk', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                SearchOutbox.drain(models)
+        db.session.rollback()
+        self.assertEqual(SearchOutbox.lag()[0], 1)
+        SearchOutbox.drain(models)
+        self.assertEqual(sorted(es.indices_data['post']), [p1.id, p3.id, p4.id])
+
+    def test_local_search(self):
+        u = User(username='nana', email='nana@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a fox and a fox', author=u)
+        p3 = Post(body='lazy dogs', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        posts, total, cursor = Post.search('foxes "', 10)
+        self.assertEqual((posts, total, cursor), ([p2, p1], 2, None))
+        self.assertEqual(Post.search('', 10)[1], 0)
+
+        p3.body = 'a lazy fox'
+        p1.delete()
+        self.assertEqual(Post.search('fox', 10)[0], [p2, p3])
+        p3.body = 'no match'
+        db.session.rollback()
+        self.assertEqual(Post.search('fox', 10)[0], [p2, p3])
+
+        posts, total, cursor = Post.search('fox', 1)
+        self.assertEqual((posts, total), ([p2], 2))
+        self.assertEqual(Post.search('fox', 1, cursor)[0], [p3])
+
+        cache = self.app.search_cache
+        hits = cache.hits
+        self.assertEqual(Post.search('fox', 1, cursor)[0], [p3])
+        self.assertEqual(cache.hits, hits + 2)
+        p3.body = 'lazy dogs'
+        db.session.commit()
+        self.assertEqual(Post.search('fox', 10)[0], [p2])
+
+        self.app.search_backend.connection.execute('DELETE FROM post')
+        result = Post.reindex(batch_size=2)
+        self.assertEqual(result['indexed'], 2)
+        self.assertEqual(Post.search('dogs', 10)[0], [p3])
+        self.assertEqual(SearchOutbox.lag()[0], 0)
+
+        # a failed index write after commit is queued for retry
+        backend = self.app.search_backend
+        with mock.patch.object(backend, 'apply',
+                               side_effect=sqlite3.OperationalError('locked')):
+            p2.body = 'a fox and a cat'
+            db.session.commit()
+        self.assertEqual(Post.search('cat', 10)[0], [])
+        self.assertEqual(SearchOutbox.lag()[0], 1)
+        SearchOutbox.drain(Post.searchable_models())
+        self.assertEqual(Post.search('cat', 10)[0], [p2])
+
+
+class StubTranslatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        items = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        self.server.requests.append((self.path, items))
+        if self.server.fail:
+            body, status = b'[]', 500
+        else:
+            body, status = json.dumps([
+                {'translations': [{'text': item['Text'].upper()}]}
+                for item in items]).encode(), 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTranslator(ThreadingHTTPServer):
+    """Local translator that upper-cases texts, counting requests and
+    connections."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubTranslatorHandler)
+        self.requests = []
+        self.connections = 0
+        self.fail = False
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 stub')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command in (b'HELO', b'EHLO', b'MAIL', b'RSET', b'NOOP'):
+                self.reply('250 ok')
+            elif command == b'RCPT':
+                self.reply('550 no such user' if b'nobody@' in line
+                           else '250 ok')
+            elif command == b'DATA':
+                if self.server.failures:
+                    self.server.failures -= 1
+                    self.reply('451 try again later')
+                    continue
+                self.reply('354 go ahead')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append(data)
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('502 not implemented')
+
+
+class StubSMTP(socketserver.ThreadingTCPServer):
+    """Local SMTP server that accepts every message, counting messages and
+    connections, and answers 451 to the next `failures` DATA commands."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.failures = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class MailCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = StubSMTP()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.server_address[1]
+            MAIL_SUPPRESS_SEND = False
+            MAIL_RETRY_BACKOFF = 0.01
+
+        self.app = create_app(MailConfig)
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+
+    def tearDown(self):
+        self.request_context.pop()
+        self.smtp.shutdown()
+        self.smtp.server_close()
+
+    def message(self, recipient='nana@example.com'):
+        return MailMessage('hello', sender='admin@example.com',
+                           recipients=[recipient], body='hi')
+
+    def test_batch_shares_connection(self):
+        self.app.mailer.send_batch([self.message() for _ in range(30)])
+        self.assertEqual(len(self.smtp.messages), 30)
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(self.app.mailer.sent, 30)
+
+    def test_retries_and_permanent_failures(self):
+        self.smtp.failures = 2
+        self.app.mailer.send_batch([self.message(),
+                                    self.message('nobody@example.com'),
+                                    self.message()])
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(self.smtp.connections, 4)
+        self.assertEqual((self.app.mailer.sent, self.app.mailer.failed),
+                         (2, 1))
+
+        self.smtp.failures = 10
+        self.app.mailer.send_batch([self.message()])
+        self.assertEqual(self.app.mailer.failed, 2)
+
+    def test_broken_messages_are_skipped(self):
+        bad_header = self.message()
+        bad_header.subject = 'hello\r\nBcc: everyone@example.com'
+        no_recipients = self.message()
+        no_recipients.recipients = []
+        self.app.mailer.send_batch([self.message(), bad_header,
+                                    no_recipients, self.message()])
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual((self.app.mailer.sent, self.app.mailer.failed),
+                         (2, 2))
+
+    def test_send_mail_is_queued(self):
+        for i in range(50):
+            send_mail('hello', sender='admin@example.com',
+                      recipients=[f'user{i}@example.com'], body='hi',
+                      html='<p>hi</p>')
+        self.app.mailer.join()
+        self.assertEqual(len(self.smtp.messages), 50)
+        self.assertLessEqual(self.smtp.connections, 50)
+        self.assertEqual(len([t for t in threading.enumerate()
+                              if t.name.startswith('mail-')]),
+                         self.app.config['MAIL_WORKERS'])
+
+    def test_backpressure(self):
+        mailer = MailDispatcher()
+        self.app.config['MAIL_WORKERS'] = 0
+        self.app.config['MAIL_QUEUE_SIZE'] = 1
+        self.app.config['MAIL_QUEUE_TIMEOUT'] = 0.01
+        mailer.init_app(self.app)
+        mailer.submit(self.message())
+        with self.assertRaises(MailQueueFull):
+            mailer.submit(self.message())
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.translator = StubTranslator()
+        self.app = create_app(TestConfig)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = self.translator.url
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+
+    def tearDown(self):
+        self.request_context.pop()
+        self.translator.shutdown()
+        self.translator.server_close()
+
+    def test_translate_is_cached(self):
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'fr'), 'HOLA')
+        self.assertEqual(translate('adios', 'es', 'en'), 'ADIOS')
+        self.assertEqual(len(self.translator.requests), 3)
+        self.assertEqual(self.translator.connections, 1)
+        path, items = self.translator.requests[0]
+        self.assertIn('from=es', path)
+        self.assertEqual(items, [{'Text': 'hola'}])
+
+    def test_failures_are_cached_briefly(self):
+        self.translator.fail = True
+        self.assertIn('Error', translate('hola', 'es', 'en'))
+        self.translator.fail = False
+        self.assertIn('Error', translate('hola', 'es', 'en'))
+        self.assertEqual(len(self.translator.requests), 1)
+        with mock.patch('application.translate.time',
+                        return_value=time.time() + 61):
+            self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(len(self.translator.requests), 2)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_shared_cache(self):
+        redis = fakeredis.FakeStrictRedis()
+        caches = [TieredCache(LRUCache(), RedisCache(redis, 'test:'))
+                  for _ in range(2)]
+        self.app.translation_cache = caches[0]
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.app.translation_cache = caches[1]
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(len(self.translator.requests), 1)
+        self.assertEqual(caches[1].local.hits, 0)
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(caches[1].local.hits, 1)
+
+    def test_translate_many(self):
+        self.app.config['TRANSLATOR_BATCH_SIZE'] = 2
+        translate('uno', 'es', 'en')
+        items = [('uno', 'es'), ('dos', 'es'), ('uno', 'es'), ('tres', 'es'),
+                 ('cuatro', 'es'), ('un', 'fr')]
+        self.assertEqual(translate_many(items, 'en'),
+                         ['UNO', 'DOS', 'UNO', 'TRES', 'CUATRO', 'UN'])
+        batches = [[item['Text'] for item in items]
+                   for _, items in self.translator.requests[1:]]
+        self.assertEqual(batches, [['dos', 'tres'], ['cuatro'], ['un']])
+        self.assertIn('from=fr', self.translator.requests[-1][0])
+
+        self.app.config['TRANSLATOR_BATCH_CHARS'] = 5
+        translate_many([('abcd', 'es'), ('efgh', 'es')], 'en')
+        self.assertEqual(len(self.translator.requests), 6)
+
+    def test_translate_batch_endpoint(self):
+        db.create_all()
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        u = User(username='nana', email='nana@example.com')
+        p1 = Post(body='hola', language='es', author=u)
+        p2 = Post(body='hola', language='es', author=u)
+        p3 = Post(body='hello', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        response = client.post('/translate/batch', json={
+            'post_ids': [p1.id, p2.id, p3.id], 'dest_language': 'en',
+            'texts': [{'text': 'bonjour', 'src_language': 'fr'}]})
+        self.assertEqual(response.get_json(), {
+            'posts': {str(p1.id): 'HOLA', str(p2.id): 'HOLA'},
+            'texts': ['BONJOUR']})
+        self.assertEqual(len(self.translator.requests), 2)
+        for body in ({'post_ids': ['x']}, {'post_ids': 5},
+                     {'texts': 'hola'}, {'texts': [5]}, [1, 2],
+                     {'texts': [{'text': 'hola', 'src_language': ['es']}]},
+                     {'texts': [{'text': 'hola', 'src_language': 'e s'}]},
+                     {'dest_language': ['en'], 'post_ids': [p1.id]},
+                     {'dest_language': {'en': 1}, 'post_ids': [p1.id]},
+                     {'dest_language': 'x' * 100, 'post_ids': [p1.id]}):
+            self.assertEqual(client.post('/translate/batch',
+                                         json=body).status_code, 400, body)
+        self.assertEqual(len(self.translator.requests), 2)
+        self.assertEqual(client.post('/translate/batch', json={
+            'post_ids': list(range(101))}).status_code, 413)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_pretranslate(self):
+        db.create_all()
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        redis = self.app.redis = fakeredis.FakeStrictRedis()
+        queue = self.app.task_queue = rq.Queue('microblog-tasks',
+                                               connection=redis)
+        self.app.translation_cache = TieredCache(
+            LRUCache(), RedisCache(redis, 'microblog:translation:'))
+        self.app.config.update(PRETRANSLATE=True, TRANSLATION_CACHE_REDIS=True,
+                               PRETRANSLATE_MIN_FOLLOWERS=1,
+                               PRETRANSLATE_MIN_VIEWS=2,
+                               PRETRANSLATE_DAILY_CHARS=40)
+        self.app.pretranslator = Pretranslator(self.app)
+
+        u1 = User(username='nana', email='nana@example.com')
+        u2 = User(username='kwame', email='kwame@example.com')
+        db.session.add_all([u1, u2])
+        u2.follow(u1)
+        db.session.commit()
+        popular = Post(body='hola a todos', language='es', author=u1)
+        quiet = Post(body='buenos dias', language='es', author=u2)
+        english = Post(body='good morning', language='en', author=u2)
+        db.session.add_all([popular, quiet, english])
+        db.session.commit()
+        self.assertEqual([job.args for job in queue.jobs], [([popular.id],)])
+
+        pretranslator = self.app.pretranslator
+        self.assertEqual(pretranslator.record_views([quiet, english]), 0)
+        self.assertEqual(pretranslator.record_views([quiet, english]), 2)
+        self.assertEqual(pretranslator.record_views([quiet, english]), 0)
+        self.assertEqual(queue.count, 2)
+
+        for job in queue.jobs:
+            tasks.pretranslate_posts(*job.args)
+        self.assertEqual(len(self.translator.requests), 3)
+        self.assertEqual(translate('hola a todos', 'es', 'en'), 'HOLA A TODOS')
+        self.assertEqual(translate('buenos dias', 'es', 'en'), 'BUENOS DIAS')
+        self.assertEqual(translate('good morning', 'en', 'es'), 'GOOD MORNING')
+        self.assertEqual(len(self.translator.requests), 3)
+
+        costly = Post(body='x' * 20, language='es', author=u1)
+        db.session.add(costly)
+        db.session.commit()
+        self.assertEqual(queue.count, 2)
+        pretranslator.max_queue = 2
+        self.assertEqual(pretranslator.enqueue([(99, 'corto', 'es')]), 0)
+
+    def test_unreachable_translator(self):
+        self.app.config['MS_TRANSLATOR_URL'] = 'http://127.0.0.1:9'
+        self.assertIn('Error', translate('hola', 'es', 'en'))
+
+
+class LocalRedis(object):
+    """In-process stand-in for the Redis pub/sub commands."""
+
+    def __init__(self):
+        self.channels = {}
+
+    def publish(self, channel, message):
+        for queue in self.channels.get(channel, []):
+            queue.append(message.encode())
+
+    def pubsub(self, **kwargs):
+        return LocalPubSub(self)
+
+
+class LocalPubSub(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.queue = deque()
+
+    def subscribe(self, channel):
+        self.redis.channels.setdefault(channel, []).append(self.queue)
+
+    def get_message(self, timeout=0):
+        if self.queue:
+            return {"type": "message", "data": self.queue.popleft()}
+
+    def close(self):
+        pass
+
+
+class NotificationStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['NOTIFICATION_STREAM'] = True
+        self.app.redis = LocalRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_stream(self):
+        u = User(username='nana', email='nana@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        response = client.get('/notifications/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.iter_encoded()
+        self.assertEqual(next(events), b': keepalive\n\n')
+
+        u = User.query.get(u.id)
+        u.add_notification('unread_message_count', 3)
+        db.session.commit()
+        event = next(events)
+        self.assertTrue(event.startswith(b'data: '))
+        notification = json.loads(event[len(b'data: '):])
+        self.assertEqual(notification['name'], 'unread_message_count')
+        self.assertEqual(notification['data'], 3)
+        response.close()
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)